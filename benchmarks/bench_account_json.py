@@ -0,0 +1,60 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# CPU time to list 1,000 accounts, with and without STORE_ACCOUNT_JSON.
+# run with:
+# python benchmarks/bench_account_json.py [requests]
+#
+# The accounts are seeded into REDIS_DB (15 by default), which is flushed.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('REDIS_DB', '15')
+import server
+
+ACCOUNTS = 1000
+
+def seed():
+    server.redis_server.flushdb()
+    server.STORE_ACCOUNT_JSON = True
+    pipe = server.redis_server.pipeline(transaction=False)
+    for id in xrange(1, ACCOUNTS + 1):
+        server.queue_account(pipe, {'id': str(id), 'name': 'Ada Lovelace', 'balance': id * 101,
+                                    'accounttype': str(id % 4), 'active': 'true',
+                                    'created_time': 1480000000 + id, 'last_updated_time': 1480000000 + id})
+        pipe.hincrby(server.ACCOUNT_VERSIONS, str(id), 1)
+    pipe.execute()
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server.inititalize_redis()
+    seed()
+    client = server.app.test_client()
+    url = '/accounts?limit=%d' % ACCOUNTS
+    for name, mode in (('hashes', False), ('json', True)):
+        server.STORE_ACCOUNT_JSON = mode
+        client.get(url)
+        cpu, wall = time.clock(), time.time()
+        for _ in xrange(number):
+            client.get(url)
+        cpu, wall = time.clock() - cpu, time.time() - wall
+        print "%-6s %7.2f ms CPU %7.2f ms wall per %d accounts listed" % (
+            name, cpu * 1000 / number, wall * 1000 / number, ACCOUNTS)
+    server.redis_server.flushdb()
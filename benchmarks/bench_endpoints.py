@@ -0,0 +1,194 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Throughput and p50/p95/p99 latency of every route at 10k, 100k and 1M
+# accounts, driven through the Flask test client against a local Redis.
+# A request is timed until the first chunk of its body, so the streamed
+# lists (?stream=1) report their time to first byte rather than the time
+# to send every account.
+# run with:
+# python benchmarks/bench_endpoints.py [--sizes 10000,100000] [--requests 200]
+#                                      [--output results.json] [--baseline old.json]
+#
+# The accounts are seeded into REDIS_DB (15 by default), which is flushed
+# first, so the benchmark never touches the data of a running service. With
+# --baseline the results are compared to a saved run and the exit status is
+# 1 when a route got slower than --threshold percent at p50 or p99.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('REDIS_DB', '15')
+import server
+from flask import json
+
+FIRST_NAMES = ['Ada', 'Alan', 'Barbara', 'Brian', 'Claude', 'Donald', 'Edsger', 'Frances', 'Grace', 'Guido',
+               'Hedy', 'Ivan', 'John', 'Joanna', 'Ken', 'Linus', 'Margaret', 'Niklaus', 'Radia', 'Tim']
+LAST_NAMES = ['Allen', 'Backus', 'Cerf', 'Dijkstra', 'Engelbart', 'Floyd', 'Gosling', 'Hopper', 'Iverson',
+              'Kay', 'Knuth', 'Lamport', 'Liskov', 'McCarthy', 'Perlman', 'Ritchie', 'Stroustrup',
+              'Thompson', 'Wirth', 'Yao']
+NAMES = ['%s %s' % (first, last) for first in FIRST_NAMES for last in LAST_NAMES]
+SEED_CHUNK_SIZE = 5000
+# Accounts per listed page, bulk create and id query
+PAGE_SIZE = 100
+YEAR = 365 * 24 * 3600
+
+######################################################################
+# Seed the accounts with the same writes the service makes
+######################################################################
+def seed(size):
+    server.redis_server.flushdb()
+    now = int(time.time())
+    pipe = server.redis_server.pipeline(transaction=False)
+    for id in xrange(size):
+        created_time = now - random.randint(0, YEAR)
+        account = {
+            'id': str(id),
+            'name': random.choice(NAMES),
+            'balance': random.randint(0, 10000000),
+            'accounttype': str(random.randint(0, 3)),
+            'active': random.choice(('true', 'false')),
+            'created_time': created_time,
+            'last_updated_time': random.randint(created_time, now),
+        }
+        server.queue_account(pipe, account)
+        if (id + 1) % SEED_CHUNK_SIZE == 0:
+            pipe.execute()
+    pipe.hset('nextId', 'nextId', size)
+    pipe.execute()
+
+######################################################################
+# The requests, as (name, method, url, body) for a dataset of size ids
+######################################################################
+def requests_for(size):
+    id = lambda: str(random.randrange(size))
+    name = lambda: random.choice(NAMES)
+    amount = json.dumps({'amount': '1.00'})
+    new_account = lambda: {'name': name(), 'balance': '100.00', 'active': 1, 'accounttype': 1}
+    account = lambda: json.dumps(new_account())
+    return [
+        ('index', 'GET', lambda: '/', None),
+        ('get account', 'GET', lambda: '/accounts/' + id(), None),
+        ('list page', 'GET', lambda: '/accounts?limit=%d&cursor=%s' % (PAGE_SIZE, id()), None),
+        ('list ids', 'GET', lambda: '/accounts?ids=' + ','.join(id() for _ in xrange(50)), None),
+        ('query ids', 'POST', lambda: '/accounts/query',
+         lambda: json.dumps({'ids': [int(id()) for _ in xrange(PAGE_SIZE)]})),
+        ('stream', 'GET', lambda: '/accounts?stream=1', None),
+        ('stream by type', 'GET', lambda: '/accounts?stream=1&type=%d' % random.randint(0, 3), None),
+        ('list by name', 'GET', lambda: '/accounts?name=' + name(), None),
+        ('list combined', 'GET', lambda: '/accounts?active=true&type=2&name=' + name(), None),
+        ('name prefix', 'GET', lambda: '/accounts?limit=10&name_prefix=' + name()[:2], None),
+        ('balance range', 'GET', lambda: '/accounts?min_balance=5000&max_balance=5100', None),
+        ('top balances', 'GET', lambda: '/accounts?sort=balance&order=desc&limit=100', None),
+        ('updated since', 'GET', lambda: '/accounts?limit=100&updated_since=%d' % (time.time() - 3600), None),
+        ('stats', 'GET', lambda: '/accounts/stats', None),
+        ('create', 'POST', lambda: '/accounts', account),
+        ('bulk create', 'POST', lambda: '/accounts/bulk',
+         lambda: json.dumps([new_account() for _ in xrange(PAGE_SIZE)])),
+        ('update', 'PUT', lambda: '/accounts/' + id(), account),
+        ('deposit', 'POST', lambda: '/accounts/%s/deposit' % id(), lambda: amount),
+        ('withdraw', 'POST', lambda: '/accounts/%s/withdraw' % id(), lambda: amount),
+        ('transfer', 'POST', lambda: '/transfers',
+         lambda: json.dumps({'from': id(), 'to': id(), 'amount': '0.01'})),
+        ('deactivate', 'PUT', lambda: '/accounts/%s/deactivate' % id(), None),
+        ('delete', 'DELETE', lambda: '/accounts/' + id(), None),
+    ]
+
+def percentile(latencies, percent):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100.0))]
+
+def run(client, method, url, body, count):
+    latencies = []
+    started = time.time()
+    for _ in xrange(count):
+        data = body() if body else None
+        path = url()
+        start = time.time()
+        response = client.open(path, method=method, data=data, content_type='application/json')
+        # the test client leaves the body to the caller, a stream is only
+        # generated as it is read
+        next(iter(response.response), None)
+        latencies.append((time.time() - start) * 1000)
+        response.close()
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'requests': count,
+        'rps': round(count / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+######################################################################
+# Compare with a saved run
+######################################################################
+def compare(results, baseline, threshold):
+    regressions = 0
+    print
+    print "%-10s %-14s %12s %12s" % ('size', 'route', 'p50 change', 'p99 change')
+    for size, routes in sorted(results['sizes'].items(), key=lambda item: int(item[0])):
+        for route, result in sorted(routes.items()):
+            before = baseline.get('sizes', {}).get(size, {}).get(route)
+            if not before:
+                continue
+            changes = [100.0 * (result[key] - before[key]) / max(before[key], 0.001) for key in ('p50_ms', 'p99_ms')]
+            slower = [change for change in changes if change > threshold]
+            regressions += len(slower) > 0
+            print "%-10s %-14s %+11.1f%% %+11.1f%%%s" % (size, route, changes[0], changes[1],
+                                                         '  SLOWER' if slower else '')
+    return regressions
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark every route of the accounts API')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated account counts')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and size')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent slower that counts as a regression')
+    args = parser.parse_args()
+
+    random.seed(42)
+    server.inititalize_redis()
+    client = server.app.test_client()
+    results = {'timestamp': int(time.time()), 'requests': args.requests, 'sizes': {}}
+    print "%-10s %-14s %10s %10s %10s %10s" % ('size', 'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        started = time.time()
+        seed(size)
+        print "%-10d seeded in %.1fs" % (size, time.time() - started)
+        results['sizes'][str(size)] = {}
+        for name, method, url, body in requests_for(size):
+            result = run(client, method, url, body, args.requests)
+            results['sizes'][str(size)][name] = result
+            print "%-10d %-14s %10.1f %10.3f %10.3f %10.3f" % (size, name, result['rps'], result['p50_ms'],
+                                                               result['p95_ms'], result['p99_ms'])
+    server.redis_server.flushdb()
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print "Results written to %s" % args.output
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        if regressions:
+            print "%d routes are more than %.0f%% slower than the baseline" % (regressions, args.threshold)
+            exit(1)
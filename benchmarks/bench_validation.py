@@ -0,0 +1,106 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Validation cost per request, before and after the single-pass validator.
+# run with:
+# python benchmarks/bench_validation.py
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import server
+
+PAYLOADS = [
+    {'name': 'Hugh Jass', 'balance': '123,000', 'active': 't', 'accounttype': 1},
+    {'name': 'Gina', 'balance': 1000, 'active': 0},
+    {'name': 'john john2', 'balance': '1.000', 'active': 'no'},
+]
+
+######################################################################
+# The validation update_account ran before: find_missing_params twice,
+# validate_balance compiling its patterns on every call, then the names
+######################################################################
+def find_missing_params(data):
+    missing_params = []
+    if not data.has_key('active'):
+        missing_params.append('active')
+    if not data.has_key('balance'):
+        missing_params.append('balance')
+    if not data.has_key('name'):
+        missing_params.append('name')
+    if data.has_key('accounttype'):
+        if data['accounttype'] not in {0,1,2,3}:
+            missing_params.append('accounttype')
+    return missing_params
+
+def validate_balance(balance):
+    balance = str(balance)
+    is_a_number = re.compile("^(-)?((((\d){1,3},(\d){1,3})+(,(\d){1,3})?(\.(\d)+)?)|((\d)+(\.)*(\d)+)|(\d)+)$")
+    if is_a_number.match(balance):
+        is_negative = re.compile("^-(.)*$")
+        if is_negative.match(balance):
+            return ('false', 'Negative values not allowed in balance parameter', balance)
+        too_many_decimals = re.compile("^(\d)*\.(\d){3,}$")
+        if too_many_decimals.match(balance):
+            return ('false', 'More than two digits after the decimal in balance parameter', balance)
+        if ',' in balance:
+            balance = re.sub(',', '', balance)
+        is_an_int = re.compile("^(\d+)$")
+        if is_an_int.match(balance):
+            balance += '.0'
+        too_few_decimals = re.compile("^(\d)*\.\d$")
+        if too_few_decimals.match(balance):
+            balance += '0'
+        return ("true", "processed", balance)
+    else:
+        return ('false', 'Not a valid number for balance parameter', balance)
+
+def validate_active(active):
+    active = str(active).lower()
+    if (active == 'true' or active == 't' or active == '1'):
+        return ('true', 'valid', 'true')
+    elif (active == 'false' or active == 'f' or active == '0'):
+        return ('true', 'valid', 'false')
+    return ('false', 'Not a valid value for active parameter', active)
+
+def legacy_validate(payload):
+    if find_missing_params(payload):
+        return find_missing_params(payload)
+    validated_balance = validate_balance(payload['balance'])
+    if validated_balance[0] is 'false':
+        return validated_balance[1]
+    validated_active = validate_active(payload['active'])
+    if validated_active[0] is 'false':
+        return validated_active[1]
+    input_name = payload['name']
+    if input_name.strip() == "":
+        return 'Invalid name.'
+    for word in input_name.split(" "):
+        if not word.isalpha():
+            return 'Invalid name.'
+
+def compiled_validate(payload):
+    return server.validate_account(payload, update=True)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for name, validate in (('before', legacy_validate), ('after', compiled_validate)):
+        seconds = timeit.timeit(lambda: [validate(payload) for payload in PAYLOADS], number=number)
+        print "%-6s %6.2f us per payload" % (name, seconds * 1e6 / (number * len(PAYLOADS)))
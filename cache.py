@@ -0,0 +1,94 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from collections import OrderedDict
+
+######################################################################
+# A bounded in-process cache that drops the least recently used entry
+# when it is full and treats entries older than ttl seconds as missing.
+# A cache with max_size 0 is disabled and never stores anything.
+#
+# A value loaded from elsewhere can be stale by the time it is stored if
+# the key was evicted while it was loading. reserve() before loading and
+# set() with the token it returned stores nothing when that happened.
+######################################################################
+class LRUCache(object):
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._reservations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # re-insert to mark it as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def reserve(self, key):
+        if not self.enabled:
+            return None
+        token = object()
+        with self._lock:
+            # loads that failed never set their reservation, so drop them
+            # all when there are too many; those loads are just not stored
+            if len(self._reservations) >= self.max_size:
+                self._reservations.clear()
+            self._reservations[key] = token
+        return token
+
+    def set(self, key, value, token=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if token is not None and self._reservations.pop(key, None) is not token:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._reservations.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._reservations.clear()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
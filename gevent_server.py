@@ -0,0 +1,41 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Serves the same app as server.py from a single gevent event loop, run with:
+# python gevent_server.py
+#
+# The standard library is patched before anything else is imported, so the
+# Redis client, its connection pool and the cache invalidation listener
+# yield to other requests while they wait on the network. Many requests can
+# then overlap their Redis round trips on one core without a thread each.
+#   GEVENT_MAX_REQUESTS   most requests served at the same time (1000)
+# REDIS_MAX_CONNECTIONS still caps the connections the requests share.
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+import server
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    server.inititalize_redis()
+    port = int(os.getenv('PORT', '5000'))
+    pool = Pool(int(os.getenv('GEVENT_MAX_REQUESTS', '1000')))
+    print "Serving on port %d with gevent" % port
+    WSGIServer(('0.0.0.0', port), server.app, spawn=pool).serve_forever()
@@ -0,0 +1,67 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# gunicorn settings for wsgi.py, tuned through the environment:
+#   PORT                  port to listen on (5000)
+#   WEB_CONCURRENCY       worker processes (2 per CPU + 1)
+#   GUNICORN_WORKER_CLASS sync, or gevent to overlap Redis I/O in a worker (sync)
+#   GUNICORN_TIMEOUT      seconds before a silent worker is restarted (30)
+#   GRACEFUL_TIMEOUT      seconds workers get to finish their requests on
+#                         shutdown or reload (30)
+#   METRICS_DIR           where workers share their metrics, so /metrics
+#                         covers all of them (a new temporary directory)
+#
+# SIGTERM stops gracefully. SIGHUP starts new workers with the current code
+# and settings and retires the old ones once they are done, so a reload
+# never drops a request. REDIS_MAX_CONNECTIONS applies to each worker.
+
+import glob
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+
+# The app is loaded in each worker, never in the master, so no Redis
+# connection is shared across a fork and a reload picks up new code
+preload_app = False
+accesslog = '-'
+
+# Set in the master, so every worker, reloaded ones included, inherits it
+TEMPORARY_METRICS_PREFIX = 'bank-metrics-'
+if not os.getenv('METRICS_DIR'):
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix=TEMPORARY_METRICS_PREFIX)
+
+# The metrics of a previous run start over
+def on_starting(server):
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+# Only the directory made above is removed
+def on_exit(server):
+    if os.path.basename(os.environ['METRICS_DIR']).startswith(TEMPORARY_METRICS_PREFIX):
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+
+def worker_exit(server, worker):
+    import server as accounts
+    if getattr(accounts, 'redis_server', None):
+        accounts.redis_server.connection_pool.disconnect()
+    # the requests served since the last flush
+    if accounts.metrics.directory:
+        accounts.metrics.flush()
@@ -0,0 +1,61 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# One-shot maintenance commands for the Redis data, run with:
+# python manage.py <command>
+
+import sys
+import server
+
+def rebuild_indexes():
+    count = server.rebuild_indexes()
+    print "Indexed %d accounts" % count
+
+def rebuild_stats():
+    count = server.rebuild_stats()
+    print "Counted %d accounts" % count
+
+def migrate():
+    count = server.migrate_accounts(progress=print_progress)
+    print
+    print "Migrated %d accounts" % count
+
+def print_progress(scanned, migrated):
+    sys.stdout.write("\rScanned %d accounts, migrated %d" % (scanned, migrated))
+    sys.stdout.flush()
+
+def memory_report():
+    report = server.memory_report()
+    print "Accounts:                        %d (%d sampled)" % (report['accounts'], report['sampled'])
+    print "Bytes per account hash, stored:  %.1f" % report['stored']
+    print "  with long field names:         %.1f" % report['long_field_names']
+    print "  compact:                       %.1f" % report['compact']
+    print "Used memory per account:         %.1f" % report['used_memory_per_account']
+
+COMMANDS = {
+    'rebuild-indexes': rebuild_indexes,
+    'rebuild-stats': rebuild_stats,
+    'migrate': migrate,
+    'memory-report': memory_report,
+}
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        print "Usage: python manage.py <%s>" % '|'.join(sorted(COMMANDS))
+        exit(1)
+    server.inititalize_redis()
+    COMMANDS[sys.argv[1]]()
@@ -0,0 +1,332 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+import redis
+from redis.client import Pipeline
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500, 1000, 5000)
+
+# Seconds between two writes of the metrics of a process to the shared directory
+FLUSH_SECONDS = 1.0
+
+######################################################################
+# Counts requests and the Redis commands they issue, per route. Recording
+# is a few dictionary updates under a lock; the Prometheus text is only
+# built when /metrics is scraped.
+#
+# Under gunicorn every worker keeps its own metrics and a scrape reaches
+# only one of them. Given a directory, each process also writes its
+# metrics there, at most once per FLUSH_SECONDS and before rendering, and
+# /metrics serves the sum over all the files, so any worker answers for
+# the whole server. Counters of workers that exited are kept, their
+# gauges are dropped.
+######################################################################
+class Metrics(object):
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        # Returns the metrics kept elsewhere, see render
+        self.extra = None
+        self.requests = {}
+        self.latencies = {}
+        self.commands = {}
+        self.round_trips = {}
+        self.command_seconds = {}
+        self.commands_per_request = {}
+        self._current = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._changed = False
+        self._flusher = None
+
+    def start_request(self):
+        self._current.started = time.time()
+        self._current.commands = 0
+        self._current.round_trips = 0
+        self._current.command_seconds = 0.0
+        self._current.breakdown = None
+
+    # Also count the commands of the current request by name, e.g. for
+    # profiles. Off by default so the names are not collected.
+    def trace_commands(self):
+        self._current.breakdown = {}
+
+    def tracing(self):
+        return getattr(self._current, 'breakdown', None) is not None
+
+    # Called once per round trip, with the number of commands it sent
+    def record_commands(self, count, seconds, names=()):
+        if getattr(self._current, 'started', None) is not None:
+            self._current.commands += count
+            self._current.round_trips += 1
+            self._current.command_seconds += seconds
+            if self._current.breakdown is not None:
+                for name in names:
+                    self._current.breakdown[name] = self._current.breakdown.get(name, 0) + 1
+
+    # What the last request of this thread asked of Redis
+    def request_commands(self):
+        return {
+            'commands': getattr(self._current, 'commands', 0),
+            'round_trips': getattr(self._current, 'round_trips', 0),
+            'seconds': getattr(self._current, 'command_seconds', 0.0),
+            'breakdown': getattr(self._current, 'breakdown', None) or {},
+        }
+
+    def finish_request(self, route, method, status):
+        started = getattr(self._current, 'started', None)
+        if started is None:
+            return
+        self._current.started = None
+        seconds = time.time() - started
+        with self._lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            observe(self.latencies, key, seconds, LATENCY_BUCKETS)
+            key = (route, method)
+            self.commands[key] = self.commands.get(key, 0) + self._current.commands
+            self.round_trips[key] = self.round_trips.get(key, 0) + self._current.round_trips
+            self.command_seconds[key] = self.command_seconds.get(key, 0.0) + self._current.command_seconds
+            observe(self.commands_per_request, key, self._current.commands, COMMAND_BUCKETS)
+            self._changed = True
+        if self.directory:
+            self.start_flusher()
+
+    # The metrics in the Prometheus text format, followed by the ones kept
+    # elsewhere, which self.extra returns as {name: (type, help, {labels: value})}
+    def render(self):
+        if self.directory:
+            self.flush()
+            snapshot = merge_snapshots(read_snapshots(self.directory))
+        else:
+            snapshot = self.snapshot()
+        lines = []
+        counter(lines, 'http_requests_total', 'Requests served.',
+                ('route', 'method', 'status'), snapshot['requests'])
+        histogram(lines, 'http_request_duration_seconds', 'Time to build a response.',
+                  ('route', 'method', 'status'), snapshot['latencies'], LATENCY_BUCKETS)
+        counter(lines, 'redis_commands_total', 'Redis commands issued while serving requests.',
+                ('route', 'method'), snapshot['commands'])
+        counter(lines, 'redis_round_trips_total', 'Redis round trips, a pipeline being one.',
+                ('route', 'method'), snapshot['round_trips'])
+        counter(lines, 'redis_command_duration_seconds_total', 'Time spent waiting on Redis.',
+                ('route', 'method'), snapshot['command_seconds'])
+        histogram(lines, 'redis_commands_per_request', 'Redis commands issued by one request.',
+                  ('route', 'method'), snapshot['commands_per_request'], COMMAND_BUCKETS)
+        for name, (type, help, values) in sorted(snapshot['extra'].items()):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for labels, value in sorted(values.items()):
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    # A copy of the metrics of this process, extra ones included
+    def snapshot(self):
+        extra = self.extra() if self.extra else {}
+        with self._lock:
+            snapshot = dict((name, dict(getattr(self, name))) for name in RECORDED)
+            for name in HISTOGRAMS:
+                snapshot[name] = dict((key, [list(counts), total, count])
+                                      for key, (counts, total, count) in snapshot[name].items())
+        snapshot['extra'] = extra
+        return snapshot
+
+    # Writes the metrics of this process to its file in the directory
+    def flush(self):
+        with self._file_lock:
+            pid = os.getpid()
+            if self._file is None or self._file[0] != pid:
+                self._file = (pid, os.path.join(self.directory, '%d-%s.json' % (pid, uuid.uuid4().hex)))
+            self._changed = False
+            write_snapshot(self._file[1], self.snapshot())
+
+    # Flushes the changes in the background, once per process
+    def start_flusher(self):
+        if self._flusher is not None and self._flusher[0] == os.getpid():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher[0] == os.getpid():
+                return
+            thread = threading.Thread(target=self.flush_changes, name='metrics-flusher')
+            thread.daemon = True
+            self._flusher = (os.getpid(), thread)
+        thread.start()
+
+    def flush_changes(self):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            if self._changed:
+                self.flush()
+
+    def reset(self):
+        with self._lock:
+            for name in RECORDED:
+                getattr(self, name).clear()
+            self._changed = True
+
+# The metrics recorded per request, and those of them that are histograms
+RECORDED = ('requests', 'latencies', 'commands', 'round_trips', 'command_seconds', 'commands_per_request')
+HISTOGRAMS = ('latencies', 'commands_per_request')
+
+# Snapshots are JSON, where label tuples become lists
+def write_snapshot(path, snapshot):
+    data = {}
+    for name in RECORDED:
+        data[name] = [[list(key), value] for key, value in snapshot[name].items()]
+    data['extra'] = dict((name, [type, help, [[[list(label) for label in labels], value]
+                                              for labels, value in values.items()]])
+                         for name, (type, help, values) in snapshot['extra'].items())
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as snapshot_file:
+        json.dump(data, snapshot_file)
+    # a reader sees either the previous file or this one, never half of it
+    os.rename(temporary, path)
+
+# The snapshots in a directory, with whether their process is still running
+def read_snapshots(directory):
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (IOError, ValueError):
+            continue
+        snapshot = {}
+        for name in RECORDED:
+            snapshot[name] = dict((tuple(key), value) for key, value in data[name])
+        snapshot['extra'] = dict((name, (type, help, dict((tuple(tuple(label) for label in labels), value)
+                                                          for labels, value in values)))
+                                 for name, (type, help, values) in data['extra'].items())
+        pid = int(os.path.basename(path).split('-')[0])
+        snapshots.append((snapshot, is_running(pid)))
+    return snapshots
+
+# Sums the snapshots of several processes, leaving out the gauges of the
+# processes that are gone
+def merge_snapshots(snapshots):
+    merged = dict((name, {}) for name in RECORDED)
+    merged['extra'] = {}
+    for snapshot, running in snapshots:
+        for name in RECORDED:
+            values = merged[name]
+            for key, value in snapshot[name].items():
+                if name not in HISTOGRAMS:
+                    values[key] = values.get(key, 0) + value
+                elif key not in values:
+                    values[key] = [list(value[0]), value[1], value[2]]
+                else:
+                    total = values[key]
+                    total[0] = [a + b for a, b in zip(total[0], value[0])]
+                    total[1] += value[1]
+                    total[2] += value[2]
+        for name, (type, help, values) in snapshot['extra'].items():
+            if type == 'gauge' and not running:
+                continue
+            merged_values = merged['extra'].setdefault(name, (type, help, {}))[2]
+            for labels, value in values.items():
+                merged_values[labels] = merged_values.get(labels, 0) + value
+    return merged
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+# Adds a value to a histogram kept as [counts per bucket, sum, count]
+def observe(histograms, key, value, buckets):
+    if key not in histograms:
+        histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+    histogram = histograms[key]
+    index = 0
+    while index < len(buckets) and value > buckets[index]:
+        index += 1
+    histogram[0][index] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+def counter(lines, name, help, label_names, values):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s counter' % name)
+    for key, value in sorted(values.items()):
+        lines.append('%s%s %s' % (name, format_labels(zip(label_names, key)), value))
+
+def histogram(lines, name, help, label_names, values, buckets):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s histogram' % name)
+    for key, (counts, total, count) in sorted(values.items()):
+        labels = zip(label_names, key)
+        cumulative = 0
+        for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels + [('le', bound)]), cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{%s}' % ','.join(escaped)
+
+# The metrics of this process, shared with the other workers through
+# METRICS_DIR when it is set, see gunicorn_config.py
+metrics = Metrics(os.getenv('METRICS_DIR') or None)
+
+######################################################################
+# A Redis client that reports every command, and every pipeline as the
+# number of commands it sends, to the request being served
+######################################################################
+class InstrumentedRedis(redis.Redis):
+
+    def execute_command(self, *args, **options):
+        start = time.time()
+        try:
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+        finally:
+            metrics.record_commands(1, time.time() - start, args[:1])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedPipeline(Pipeline):
+
+    # Commands sent right away while keys are WATCHed
+    def immediate_execute_command(self, *args, **options):
+        start = time.time()
+        try:
+            return super(InstrumentedPipeline, self).immediate_execute_command(*args, **options)
+        finally:
+            metrics.record_commands(1, time.time() - start, args[:1])
+
+    def execute(self, raise_on_error=True):
+        count = len(self.command_stack)
+        names = [args[0] for args, options in self.command_stack] if metrics.tracing() else ()
+        start = time.time()
+        try:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        finally:
+            metrics.record_commands(count, time.time() - start, names)
@@ -0,0 +1,123 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from flask import g, request
+from metrics import metrics
+
+######################################################################
+# Profiles a sample of the requests with cProfile and keeps the ones
+# slower than a threshold. Every kept request is written to directory as
+# <time>-<method>-<route>-<ms>ms.prof, which pstats, snakeviz or gprof2dot
+# can load, next to a .json file with its route, parameters, status and
+# the Redis commands it issued by name. Only the newest max_files are kept.
+# A profiler without a directory is disabled.
+#
+# The overhead is bounded by the sample rate and by profiling at most
+# max_concurrent requests of a process at a time; the other requests only
+# pay for one random number.
+######################################################################
+class RequestProfiler(object):
+
+    def __init__(self, directory=None, sample_rate=0.01, slow_ms=200, max_files=50, max_concurrent=1):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_files = max_files
+        self._slots = threading.Semaphore(max_concurrent)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.sample_rate > 0
+
+    def install(self, app):
+        app.before_request(self.start)
+        app.after_request(self.record_status)
+        app.teardown_request(self.finish)
+
+    def start(self):
+        if not self.enabled or random.random() >= self.sample_rate or not self._slots.acquire(False):
+            return
+        metrics.trace_commands()
+        g.profile = cProfile.Profile()
+        g.profile_started = time.time()
+        g.profile.enable()
+
+    def record_status(self, response):
+        g.profile_status = response.status_code
+        return response
+
+    # Runs even when the view raised, so a profile is never left enabled
+    def finish(self, error=None):
+        profile = getattr(g, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        g.profile = None
+        self._slots.release()
+        milliseconds = (time.time() - g.profile_started) * 1000
+        if milliseconds >= self.slow_ms:
+            self.write(profile, milliseconds, getattr(g, 'profile_status', 500))
+
+    def write(self, profile, milliseconds, status):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        now = time.time()
+        name = '%s.%06d-%s-%s-%dms' % (time.strftime('%Y%m%d%H%M%S', time.localtime(now)), now % 1 * 1e6,
+                                       request.method, re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'index',
+                                       milliseconds)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + '.prof')
+        with open(path + '.json', 'w') as details:
+            json.dump({
+                'route': route,
+                'method': request.method,
+                'path': request.path,
+                'args': request.args.to_dict(flat=False),
+                'status': status,
+                'duration_ms': round(milliseconds, 3),
+                'redis': metrics.request_commands(),
+            }, details, indent=2, sort_keys=True)
+        self.rotate()
+
+    def rotate(self):
+        with self._lock:
+            profiles = sorted(glob.glob(os.path.join(self.directory, '*.prof')), key=os.path.getmtime)
+            for old in profiles[:max(0, len(profiles) - self.max_files)]:
+                for path in (old, old[:-len('.prof')] + '.json'):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+# The profiler of a process, enabled when PROFILE_DIR is set and tuned
+# through the environment:
+#   PROFILE_DIR             where the profiles are written (off when unset)
+#   PROFILE_SAMPLE_RATE     share of the requests profiled (0.01)
+#   PROFILE_SLOW_MS         only keep profiles of requests this slow (200)
+#   PROFILE_MAX_FILES       profiles kept, oldest are deleted first (50)
+#   PROFILE_MAX_CONCURRENT  requests profiled at a time per process (1)
+def profiler_from_environment():
+    return RequestProfiler(os.getenv('PROFILE_DIR'),
+                           sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', '0.01')),
+                           slow_ms=float(os.getenv('PROFILE_SLOW_MS', '200')),
+                           max_files=int(os.getenv('PROFILE_MAX_FILES', '50')),
+                           max_concurrent=int(os.getenv('PROFILE_MAX_CONCURRENT', '1')))
@@ -13,24 +13,59 @@
 # limitations under the License.
 
 import datetime
+import hashlib
 import os
+import random
 import redis
 import re
-from redis.exceptions import ConnectionError
-from flask import Flask, Response, jsonify, request, json
+import string
+import threading
+import time
+from redis.exceptions import ConnectionError, RedisError, WatchError
+from flask import Flask, Response, g, jsonify, request, json
+from cache import LRUCache
+from metrics import InstrumentedRedis, metrics
+from profiling import profiler_from_environment
 
 # Create Flask application
 app = Flask(__name__)
 
+# Optional read-through cache for single account reads, e.g.
+# ACCOUNT_CACHE_SIZE=10000 ACCOUNT_CACHE_TTL=5. Every write publishes the
+# account id on ACCOUNT_INVALIDATION_CHANNEL so all processes drop it.
+account_cache = LRUCache(int(os.getenv('ACCOUNT_CACHE_SIZE', '0')), float(os.getenv('ACCOUNT_CACHE_TTL', '5')))
+ACCOUNT_INVALIDATION_CHANNEL = 'accounts:invalidate'
+invalidation_listener = None
+
+# Optional copy of every account as the JSON the API returns, stored under
+# json:<id> with STORE_ACCOUNT_JSON=true, see PRE-SERIALIZED ACCOUNTS
+STORE_ACCOUNT_JSON = os.getenv('STORE_ACCOUNT_JSON', 'false').lower() in ('true', '1')
+JSON_PREFIX = 'json:'
+
+# The field of an account hash behind every account field, see STORAGE FORMAT
+FIELD_CODES = {
+    'name': 'n',
+    'balance': 'b',
+    'accounttype': 't',
+    'active': 'a',
+    'created_time': 'c',
+    'last_updated_time': 'u',
+}
+FIELD_NAMES = dict((code, field) for field, code in FIELD_CODES.iteritems())
+
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_403_ACCESS_FORBIDDEN = 403
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -38,59 +73,125 @@ HTTP_409_CONFLICT = 409
 def index():
     return jsonify(name='Banking System REST API Service', version='1.0', url='/accounts'), HTTP_200_OK
 
+######################################################################
+# GET DIAGNOSTICS
+######################################################################
+@app.route('/diagnostics')
+def diagnostics():
+    return reply({ 'redis_pool' : redis_pool_stats(), 'account_cache' : account_cache.stats() }, HTTP_200_OK)
+
+######################################################################
+# GET TOTALS OVER ALL ACCOUNTS
+######################################################################
+@app.route('/accounts/stats', methods=['GET'])
+def get_account_stats():
+    return reply(load_stats(), HTTP_200_OK)
+
+######################################################################
+# GET METRICS IN THE PROMETHEUS TEXT FORMAT
+######################################################################
+@app.route('/metrics')
+def get_metrics():
+    response = Response(metrics.render())
+    response.headers['Content-Type'] = PROMETHEUS_CONTENT_TYPE
+    return response
+
 ######################################################################
 # LIST ALL ACCOUNTS WITHOUT A CERTAIN NAME :/accounts
 # LIST ALL ACCOUNTS WITH A CERTAIN NAME: /accounts?name=john
 # LIST ALL ACCOUNTS WITH A CERTAIN ACCOUNT-TYPE: /accounts?type=1
 # LIST ALL ACCOUNTS WITH A STATUS ACTIVE: /accounts?active=true
+# LIST ONE PAGE OF ACCOUNTS: /accounts?limit=100&cursor=<next_cursor>
+# LIST ACCOUNTS IN A BALANCE RANGE: /accounts?min_balance=10&max_balance=20
+# LIST THE TOP BALANCES: /accounts?sort=balance&order=desc&limit=100
+# LIST ACCOUNTS CREATED IN A TIME WINDOW: /accounts?created_after=<time>&created_before=<time>
+# LIST ACCOUNTS CHANGED SINCE A TIME: /accounts?updated_since=<time>
+# SEARCH ACCOUNTS BY THE START OF THEIR NAME: /accounts?name_prefix=jo&limit=10
+# COMBINE ANY OF THE FILTERS ABOVE: /accounts?active=true&type=2&name=Xi
+# STREAM ACCOUNTS AS NDJSON: /accounts?stream=1 or Accept: application/x-ndjson
+# RETRIEVE MANY ACCOUNTS BY ID: /accounts?ids=1,2,3
 ######################################################################
 @app.route('/accounts', methods=['GET'])
 def list_accounts():
+    ids = request.args.get('ids')
+    if ids:
+        return query_accounts(ids.split(','))
     name = request.args.get('name')
     type = request.args.get('type')
     active = request.args.get('active')
-    if name:
-        message = []
-        for key in redis_server.keys():
-            account = redis_server.hgetall(key)
-            if account.has_key('name'):
-                if account.get('name')==name:
-                    message.append(account)
-                    rc = HTTP_200_OK
-        if not message:
-            message = { 'error' : 'Account under name: %s is not found' % name }
-            rc = HTTP_404_NOT_FOUND
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    stream = wants_stream()
+    combined = is_combined_query(request.args)
+    key = None
+    if combined:
+        # every write bumps the generation of index:id
+        key = ID_INDEX
+    elif name:
+        key = index_key('name', name)
+        error = 'Account under name: %s is not found' % name
     elif type:
-    	message = []
-	for key in redis_server.keys():
-		account = redis_server.hgetall(key)
-		if account.has_key('accounttype'):
-			if account.get('accounttype')==type:
-				message.append(account)
-		    		rc = HTTP_200_OK
-	if not message:
-		message = { 'error' : 'Accounts with type: %s not found' % type }
-    		rc = HTTP_404_NOT_FOUND
+        key = index_key('accounttype', type)
+        error = 'Accounts with type: %s not found' % type
     elif active:
-    	message = []
-    	for key in redis_server.keys():
-    		account = redis_server.hgetall(key)
-    		if account.has_key('active'):
-    			if account.get('active') == active:
-    				message.append(account)
-    				rc = HTTP_200_OK
-    	if not message:
-    		message = { 'error' : 'Accounts with status: %s not found' % active}
-    		rc = HTTP_404_NOT_FOUND
+        key = index_key('active', active)
+        error = 'Accounts with status: %s not found' % active
+    elif 'name_prefix' in request.args:
+        key = NAME_LEX_INDEX
+    elif 'min_balance' in request.args or 'max_balance' in request.args or 'sort' in request.args:
+        key = BALANCE_INDEX
+    elif 'updated_since' in request.args:
+        key = UPDATED_INDEX
+    elif 'created_after' in request.args or 'created_before' in request.args:
+        key = CREATED_INDEX
+
+    # a list is unchanged while the index it reads is unchanged
+    etag = list_etag(key or ID_INDEX)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    if combined:
+        error, message = combined_query(request.args)
+        rc = HTTP_200_OK
+        if error:
+            message = { 'error' : error }
+            rc = HTTP_400_BAD_REQUEST
+    elif key in RANGE_QUERIES:
+        error, ids = RANGE_QUERIES[key](request.args)
+        if error:
+            message = { 'error' : error }
+            rc = HTTP_400_BAD_REQUEST
+        else:
+            message = fetch_accounts(ids, in_order=True)
+            rc = HTTP_200_OK
+    elif key and stream:
+        # an index set only exists while it has members
+        if redis_server.exists(key):
+            return stream_reply(iter_accounts(unique(redis_server.sscan_iter(key, count=STREAM_BATCH_SIZE))), etag)
+        message = { 'error' : error }
+        rc = HTTP_404_NOT_FOUND
+    elif key:
+        message = fetch_accounts(redis_server.smembers(key))
+        rc = HTTP_200_OK
+        if not message:
+            message = { 'error' : error }
+            rc = HTTP_404_NOT_FOUND
+    elif limit or cursor:
+        if not is_page_size(limit) or (cursor and not is_account_key(cursor)):
+            message = { 'error' : 'Invalid limit or cursor' }
+            rc = HTTP_400_BAD_REQUEST
+        else:
+            # the cursor is the last id of the previous page
+            ids = redis_server.zrangebyscore(ID_INDEX, '(%s' % cursor if cursor else '-inf', '+inf', start=0, num=int(limit))
+            next_cursor = ids[-1] if len(ids) == int(limit) else None
+            message = { 'accounts' : fetch_accounts(ids), 'next_cursor' : next_cursor }
+            rc = HTTP_200_OK
+    elif stream:
+        return stream_reply(iter_accounts(iter_all_ids()), etag)
     else :
-        message = []
+        message = fetch_accounts(redis_server.zrange(ID_INDEX, 0, -1))
         rc = HTTP_200_OK
-        for key in redis_server.keys():
-            if (key == 'nextId'):
-                continue
-            account = redis_server.hgetall(key)
-            message.append(account)
-    return reply(message, rc)
+    return reply(message, rc, etag if rc == HTTP_200_OK else None)
 
 ######################################################################
 # RETRIEVE AN ACCOUNT WITH ID
@@ -98,16 +199,51 @@ def list_accounts():
 @app.route('/accounts/<id>', methods=['GET'])
 def get_account_by_id(id):
     message = []
-    if id == 'nextId':
+    etag = None
+    if not is_account_key(id):
         message = {'error' : 'Account id: %s is not found' % id }
         rc = HTTP_404_NOT_FOUND
-    elif redis_server.exists(id):
-        message = redis_server.hgetall(id)
+    else:
+        cached = account_cache.get(id)
+        if cached is None and request.if_none_match:
+            # answer a poll for an unchanged account from its version alone
+            version = redis_server.hget(ACCOUNT_VERSIONS, id)
+            if version and request.if_none_match.contains(account_etag(version)):
+                return not_modified(account_etag(version))
+        if cached is None:
+            # an invalidation that arrives while it loads cancels the reservation
+            token = account_cache.reserve(id)
+            cached = load_account(id)
+            if cached[1]:
+                account_cache.set(id, cached, token)
+        version, message = cached
+        etag = account_etag(version)
+        if message and request.if_none_match.contains(etag):
+            return not_modified(etag)
         rc = HTTP_200_OK
     if not message:
         message = { 'error' : 'Account id: %s is not found' % id }
         rc = HTTP_404_NOT_FOUND
-    return reply(message, rc)
+        etag = None
+    return reply(message, rc, etag)
+
+######################################################################
+# RETRIEVE MANY ACCOUNTS BY ID
+# The body is {"ids": [1, 2, 3]}
+######################################################################
+@app.route('/accounts/query', methods=['POST'])
+def query_accounts_by_ids():
+    payload = []
+    try:
+        payload = json.loads(request.data)
+    except Exception as err:
+        return reply({'error' : format(err)}, HTTP_400_BAD_REQUEST)
+    if not isinstance(payload, dict) or not isinstance(payload.get('ids'), list):
+        return reply({'error' : 'Missing or invalid ids'}, HTTP_400_BAD_REQUEST)
+    ids = [json_id(id) for id in payload['ids']]
+    if None in ids:
+        return reply({'error' : 'Ids must be integers or strings'}, HTTP_400_BAD_REQUEST)
+    return query_accounts(ids)
 
 ######################################################################
 # DEACTIVATE AN ACCOUNT WITH ID
@@ -118,13 +254,22 @@ def get_account_by_id(id):
 @app.route('/accounts/<id>/deactivate', methods=['PUT'])
 def deactivate_account_by_id(id):
     message = []
-    for account in redis_server.keys():
-        if account == 'nextId':
-            continue
-        if account == id:
-            redis_server.hset(id, 'active', 'false')
-            message = redis_server.hgetall(account)
-            rc = HTTP_200_OK
+    def deactivate(pipe, account, fields):
+        remove_from_indexes(pipe, account)
+        account['active'] = 'false'
+        account['last_updated_time'] = current_time()
+        pipe.hmset(id, {stored_field(fields, 'active'): 'false',
+                        stored_field(fields, 'last_updated_time'): account['last_updated_time']})
+        add_to_indexes(pipe, account)
+        queue_invalidation(pipe, id)
+    account = write_account(id, deactivate) if is_account_key(id) else {}
+    if account:
+        account_cache.evict(id)
+        message = decode_account(account)
+        rc = HTTP_200_OK
+    elif account is None:
+        message = { 'error' : BUSY_ERROR % id }
+        rc = HTTP_409_CONFLICT
 
     if not message:
         message = { 'error' : 'Account id: %s is not found' % id }
@@ -141,63 +286,65 @@ def create_account():
         payload = json.loads(request.data)
     except Exception as err:
         return reply({'error' : format(err)}, HTTP_400_BAD_REQUEST)
-    missing_params = find_missing_params(payload)
-    if not missing_params:
-        #validations here
-        validated_balance = validate_balance(payload['balance'])
-
-        if validated_balance[0] is 'false':
-            message = {'error' : validated_balance[1]}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-
-        validated_active = validate_active(payload['active'])
-
-        if validated_active[0] is 'false':
-             message = {'error' : validated_active[1]}
-             rc = HTTP_400_BAD_REQUEST
-             return reply(message, rc)
+    errors, account = build_account(payload)
+    if not errors:
+        account['id'] = ID_PLACEHOLDER
+        pipe = redis_server.pipeline()
+        queue_account(pipe, account)
+        queue_invalidation(pipe, ID_PLACEHOLDER)
+        account['id'] = execute_with_next_id(pipe)
+        message = decode_account(account)
+        rc = HTTP_201_CREATED
+    else:
+        return invalid_reply(errors)
 
-        #end validations
+    return reply(message, rc)
 
+######################################################################
+# CREATE MANY ACCOUNTS AT ONCE
+# The body is either a JSON array of accounts or one account per line
+# with Content-Type: application/x-ndjson
+######################################################################
+@app.route('/accounts/bulk', methods=['POST'])
+def create_accounts_in_bulk():
+    payloads = []
+    try:
+        if request.mimetype == NDJSON_CONTENT_TYPE:
+            payloads = [json.loads(line) for line in request.data.splitlines() if line.strip()]
+        else:
+            payloads = json.loads(request.data)
+    except Exception as err:
+        return reply({'error' : format(err)}, HTTP_400_BAD_REQUEST)
+    if not isinstance(payloads, list) or not payloads or len(payloads) > MAX_BULK_SIZE:
+        message = { 'error' : 'Expected between 1 and %d accounts' % MAX_BULK_SIZE }
+        return reply(message, HTTP_400_BAD_REQUEST)
 
-        # start name validation
-        input_name = payload['name']
-        if input_name.strip() == "":
-            message = {'error' : 'Invalid name.'}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-
-        words = input_name.split(" ");
-        for word in words:
-            if not word.isalpha():
-                message = {'error' : 'Invalid name.'}
-                rc = HTTP_400_BAD_REQUEST
-                return reply(message, rc)
-        # end name validation
-
-        id = redis_server.hget('nextId', 'nextId')
-        redis_server.hset('nextId','nextId',int(id) + 1)
-        redis_server.hset(id, 'id', id)
-        redis_server.hset(id, 'name',  payload['name'])
-        redis_server.hset(id, 'balance', validated_balance[2])
-        redis_server.hset(id, 'active', validated_active[2])
-        created_time = (datetime.datetime.now() - datetime.timedelta(hours=5)).strftime("%Y-%m-%d %H:%M:%S")
-        redis_server.hset(id, 'created_time', created_time)
-        redis_server.hset(id, 'last_updated_time', created_time)
-
-        #Check if payload contains accounttype else assign 0 as a default value
-        if payload.has_key('accounttype'):
-            redis_server.hset(id, 'accounttype', payload['accounttype'])
+    results = []
+    accounts = []
+    for index, payload in enumerate(payloads):
+        errors, account = build_account(payload)
+        if errors:
+            results.append({ 'index' : index, 'status' : HTTP_400_BAD_REQUEST, 'error' : errors[0], 'errors' : errors })
         else:
-            redis_server.hset(id, 'accounttype', 0)
+            results.append({ 'index' : index, 'status' : HTTP_201_CREATED })
+            accounts.append((results[-1], account))
 
-        message = redis_server.hgetall(id)
-        rc = HTTP_201_CREATED
-    else:
-        message = { 'error' : 'Missing or invalid %s' % missing_params }
-        rc = HTTP_400_BAD_REQUEST
+    if accounts:
+        # reserve a block of ids with a single HINCRBY. Only existing
+        # accounts are cached, so the new ones just get a version.
+        first_id = redis_server.hincrby('nextId', 'nextId', len(accounts)) - len(accounts)
+        pipe = redis_server.pipeline()
+        for offset, (result, account) in enumerate(accounts):
+            account['id'] = str(first_id + offset)
+            queue_account(pipe, account)
+            pipe.hincrby(ACCOUNT_VERSIONS, account['id'], 1)
+            result['account'] = decode_account(account)
+            if (offset + 1) % BULK_CHUNK_SIZE == 0:
+                pipe.execute()
+        pipe.execute()
 
+    message = { 'created' : len(accounts), 'failed' : len(payloads) - len(accounts), 'results' : results }
+    rc = HTTP_201_CREATED if accounts else HTTP_400_BAD_REQUEST
     return reply(message, rc)
 
 ######################################################################
@@ -210,157 +357,1256 @@ def update_account(id):
         payload = json.loads(request.data)
     except Exception as err:
         return reply({"error" : format(err)}, HTTP_400_BAD_REQUEST)
-    if id == 'nextId':
+    errors, values = validate_account(payload, update=True)
+    def update(pipe, account, fields):
+        remove_from_indexes(pipe, account)
+        account.update(values)
+        account['last_updated_time'] = current_time()
+        queue_hash(pipe, account)
+        add_to_indexes(pipe, account)
+        queue_invalidation(pipe, id)
+    account = write_account(id, update) if is_account_key(id) and not errors else {}
+    if not is_account_key(id):
         message = {'error' : 'Account %s is not found' % id}
         rc = HTTP_404_NOT_FOUND
-    elif find_missing_params(payload):
-        message = { 'error' : 'Missing or invalid %s' % find_missing_params(payload) }
-        rc = HTTP_400_BAD_REQUEST
-    elif redis_server.exists(id):
-        # not allowed to change created_time
-        if payload.has_key('created_time'):
-            message = {'error' : 'Field created_time is not allowed to change'}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-
-        # not allowed to change last_updated_time
-        if payload.has_key('last_updated_time'):
-            message = {'error' : 'Field last_updated_time is not allowed to change'}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-
-        #validation
-        validated_balance = validate_balance(payload['balance'])
-
-        if validated_balance[0] is 'false':
-            message = {'error' : validated_balance[1]}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-
-        validated_active = validate_active(payload['active'])
-
-        if validated_active[0] is 'false':
-            message = {'error' : validated_active[1]}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-        #end validation
-
-        # start name validation
-        input_name = payload['name']
-        if input_name.strip() == "":
-            message = {'error' : 'Invalid name.'}
-            rc = HTTP_400_BAD_REQUEST
-            return reply(message, rc)
-
-        words = input_name.split(" ");
-        for word in words:
-            if not word.isalpha():
-                message = {'error' : 'Invalid name.'}
-                rc = HTTP_400_BAD_REQUEST
-                return reply(message, rc)
-        # end name validation
-
-
-        redis_server.hset(id, 'name', payload['name'])
-        redis_server.hset(id, 'active', validated_active[2])
-        redis_server.hset(id, 'balance', validated_balance[2])
-        redis_server.hset(id, 'last_updated_time', (datetime.datetime.now() - datetime.timedelta(hours=5)).strftime("%Y-%m-%d %H:%M:%S"))
-        #Check if payload contains accounttype
-        if payload.has_key('accounttype'):
-            redis_server.hset(id, 'accounttype', payload['accounttype'])
-        message = redis_server.hgetall(id)
+    elif errors:
+        return invalid_reply(errors)
+    elif account:
+        account_cache.evict(id)
+        message = decode_account(account)
         rc = HTTP_200_OK
+    elif account is None:
+        message = { 'error' : BUSY_ERROR % id }
+        rc = HTTP_409_CONFLICT
     else:
         message = { 'error' : 'Account id: %s was not found' % id }
         rc = HTTP_404_NOT_FOUND
 
     return reply(message, rc)
 
+######################################################################
+# DEPOSIT TO AN ACCOUNT
+# WITHDRAW FROM AN ACCOUNT
+# The body is {"amount": "10.50"}
+######################################################################
+@app.route('/accounts/<id>/deposit', methods=['POST'])
+def deposit(id):
+    return change_balance(id, 1)
+
+@app.route('/accounts/<id>/withdraw', methods=['POST'])
+def withdraw(id):
+    return change_balance(id, -1)
+
+######################################################################
+# TRANSFER MONEY BETWEEN TWO ACCOUNTS
+# The body is {"from": 1, "to": 2, "amount": "10.50"}
+######################################################################
+@app.route('/transfers', methods=['POST'])
+def create_transfer():
+    payload = []
+    try:
+        payload = json.loads(request.data)
+    except Exception as err:
+        return reply({'error' : format(err)}, HTTP_400_BAD_REQUEST)
+    error, cents = parse_amount(payload)
+    if error:
+        return reply({'error' : error}, HTTP_400_BAD_REQUEST)
+    from_id = json_id(payload.get('from'))
+    to_id = json_id(payload.get('to'))
+    if from_id is None or to_id is None:
+        return reply({'error' : 'Missing or invalid from or to'}, HTTP_400_BAD_REQUEST)
+    if from_id == to_id:
+        return reply({'error' : 'Cannot transfer to the same account'}, HTTP_400_BAD_REQUEST)
+    for id in (from_id, to_id):
+        if not is_account_key(id):
+            return reply({'error' : BALANCE_ERRORS['missing'][1] % id}, HTTP_404_NOT_FOUND)
+
+    result = transfer_script(args=[from_id, to_id, cents, current_time()])
+    account_cache.evict(from_id)
+    account_cache.evict(to_id)
+    if result[0] != 'ok':
+        return balance_error_reply(result)
+    message = {
+        'amount' : format_cents(cents),
+        'from' : { 'id' : from_id, 'balance' : format_cents(result[1]) },
+        'to' : { 'id' : to_id, 'balance' : format_cents(result[2]) },
+    }
+    return reply(message, HTTP_200_OK)
+
 ######################################################################
 # DELETE AN ACCOUNT
 ######################################################################
 @app.route('/accounts/<id>', methods=['DELETE'])
 def delete_account(id):
-    if redis_server.exists(id):
-        redis_server.delete(id)
+    def delete(pipe, account, fields):
+        pipe.delete(id)
+        remove_from_indexes(pipe, account)
+        queue_invalidation(pipe, id, deleted=True)
+    account = write_account(id, delete) if is_account_key(id) else {}
+    if account is None:
+        return reply({ 'error' : BUSY_ERROR % id }, HTTP_409_CONFLICT)
+    if account:
+        account_cache.evict(id)
 
     return '', HTTP_204_NO_CONTENT
 
+######################################################################
+#  I N D E X E S
+######################################################################
+# Every account is also a member of one set per indexed field, e.g.
+# index:name:Gina, index:accounttype:0 and index:active:true, so the
+# filtered lists only read the accounts that match. index:id is a sorted
+# set of all ids scored by id, used to page through every account,
+# index:balance scores them by balance in cents for range and top-K queries
+# and index:created_time and index:last_updated_time by epoch seconds for
+# time windows. index:name_lex holds "<lowercase name>:<id>" at score 0, so
+# ZRANGEBYLEX finds names by prefix regardless of case.
+INDEX_PREFIX = 'index:'
+INDEXED_FIELDS = ('name', 'accounttype', 'active')
+ID_INDEX = INDEX_PREFIX + 'id'
+BALANCE_INDEX = INDEX_PREFIX + 'balance'
+CREATED_INDEX = INDEX_PREFIX + 'created_time'
+UPDATED_INDEX = INDEX_PREFIX + 'last_updated_time'
+NAME_LEX_INDEX = INDEX_PREFIX + 'name_lex'
+# The sorted sets every account is in, whose generations every change to
+# an account bumps, including the balance scripts
+ACCOUNT_INDEXES = (ID_INDEX, BALANCE_INDEX, CREATED_INDEX, UPDATED_INDEX, NAME_LEX_INDEX)
+
+# Change counters behind the ETags: one version per account and one
+# generation per index, bumped whenever an account in it changes. They
+# survive rebuild_indexes so a tag is never reused for other content.
+ACCOUNT_VERSIONS = 'version:accounts'
+INDEX_GENERATIONS = 'version:indexes'
+
+def index_key(field, value):
+    return '%s%s:%s' % (INDEX_PREFIX, field, value)
+
+# Names only contain letters and spaces, so ':' separates the name from the id
+def name_lex_member(account):
+    return '%s:%s' % (normalize_name(account['name']), account['id'])
+
+def normalize_name(name):
+    return normalize_value(name).decode('utf-8').lower().encode('utf-8')
+
+# Query parameters are unicode, stored values are UTF-8
+def normalize_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+# Account hashes are stored under their numeric id. isdigit() would also
+# accept other digits, e.g. Arabic-Indic ones, which Redis cannot compare.
+DIGITS_PATTERN = re.compile(r'^[0-9]+\Z')
+
+def is_account_key(key):
+    return DIGITS_PATTERN.match(key) is not None
+
+# Queue the index updates for an account on a pipeline
+def add_to_indexes(pipe, account):
+    for field in INDEXED_FIELDS:
+        if account.has_key(field):
+            pipe.sadd(index_key(field, account[field]), account['id'])
+            pipe.hincrby(INDEX_GENERATIONS, index_key(field, account[field]), 1)
+    pipe.zadd(ID_INDEX, account['id'], account['id'])
+    pipe.zadd(BALANCE_INDEX, account['id'], stored_cents(account['balance']))
+    pipe.zadd(CREATED_INDEX, account['id'], stored_time(account['created_time']))
+    pipe.zadd(UPDATED_INDEX, account['id'], stored_time(account['last_updated_time']))
+    pipe.zadd(NAME_LEX_INDEX, name_lex_member(account), 0)
+    for index in ACCOUNT_INDEXES:
+        pipe.hincrby(INDEX_GENERATIONS, index, 1)
+    queue_stats(pipe, account, 1)
+    if STORE_ACCOUNT_JSON:
+        pipe.set(json_key(account['id']), json.dumps(decode_account(account)))
+
+def remove_from_indexes(pipe, account):
+    for field in INDEXED_FIELDS:
+        if account.has_key(field):
+            pipe.srem(index_key(field, account[field]), account['id'])
+            pipe.hincrby(INDEX_GENERATIONS, index_key(field, account[field]), 1)
+    pipe.zrem(ID_INDEX, account['id'])
+    pipe.zrem(BALANCE_INDEX, account['id'])
+    pipe.zrem(CREATED_INDEX, account['id'])
+    pipe.zrem(UPDATED_INDEX, account['id'])
+    pipe.zrem(NAME_LEX_INDEX, name_lex_member(account))
+    for index in ACCOUNT_INDEXES:
+        pipe.hincrby(INDEX_GENERATIONS, index, 1)
+    queue_stats(pipe, account, -1)
+    # dropped even when STORE_ACCOUNT_JSON is off, so it is never stale
+    pipe.delete(json_key(account['id']))
+
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+MAX_BULK_SIZE = 50000
+BULK_CHUNK_SIZE = 1000
+
+def is_page_size(limit):
+    return limit is not None and DIGITS_PATTERN.match(limit) is not None and 0 < int(limit) <= MAX_PAGE_SIZE
+
+# Looks up the given ids with one pipelined batch of HGETALLs and replies
+# with the accounts found and the ids that were not
+def query_accounts(ids):
+    if len(ids) > MAX_PAGE_SIZE:
+        message = { 'error' : 'At most %d ids can be queried at once' % MAX_PAGE_SIZE }
+        return reply(message, HTTP_400_BAD_REQUEST)
+    pipe = redis_server.pipeline(transaction=False)
+    for id in ids:
+        if is_account_key(id):
+            pipe.hgetall(id)
+    accounts = iter(pipe.execute())
+    found = []
+    missing = []
+    for id in ids:
+        account = account_from_hash(id, next(accounts)) if is_account_key(id) else None
+        if account:
+            found.append(decode_account(account))
+        else:
+            missing.append(id)
+    return reply({ 'found' : found, 'missing' : missing }, HTTP_200_OK)
+
+# Parses ?min_balance= and ?max_balance= (on index:balance), ?created_after=
+# and ?created_before= (on index:created_time, exclusive) and ?updated_since=
+# (on index:last_updated_time) into {index: (low, high, exclusive)}, with
+# None for an open end. Returns (error, ranges).
+def parse_score_ranges(args):
+    ranges = {}
+    for index, low_field, high_field, parse, exclusive in (
+            (BALANCE_INDEX, 'min_balance', 'max_balance', parse_cents, False),
+            (CREATED_INDEX, 'created_after', 'created_before', parse_time, True),
+            (UPDATED_INDEX, 'updated_since', None, parse_time, False)):
+        bounds = []
+        for field in (low_field, high_field):
+            error, value = parse(args[field], field) if field and args.get(field) else (None, None)
+            if error:
+                return (error, None)
+            bounds.append(value)
+        if bounds != [None, None]:
+            ranges[index] = (bounds[0], bounds[1], exclusive)
+    return (None, ranges)
+
+# A range as the min and max arguments of ZRANGEBYSCORE and ZCOUNT
+def score_range_args(low, high, exclusive):
+    prefix = '(' if exclusive else ''
+    return ('-inf' if low is None else '%s%d' % (prefix, low),
+            '+inf' if high is None else '%s%d' % (prefix, high))
+
+def in_score_range(score, low, high, exclusive):
+    if exclusive:
+        return (low is None or score > low) and (high is None or score < high)
+    return (low is None or score >= low) and (high is None or score <= high)
+
+# The score of a stored account in each sorted set index
+INDEX_SCORES = {
+    BALANCE_INDEX: lambda account: stored_cents(account['balance']),
+    CREATED_INDEX: lambda account: stored_time(account['created_time']),
+    UPDATED_INDEX: lambda account: stored_time(account['last_updated_time']),
+}
+
+def is_sort_valid(args):
+    limit = args.get('limit')
+    return args.get('sort', 'balance') == 'balance' and args.get('order', 'asc') in ('asc', 'desc') \
+        and (not limit or is_page_size(limit))
+
+# Reads the ids for ?min_balance=, ?max_balance= and ?sort=balance&order=desc
+# from index:balance, at most ?limit= of them. Returns (error, ids).
+def balance_range(args):
+    error, ranges = parse_score_ranges(args)
+    if error:
+        return (error, None)
+    if not is_sort_valid(args):
+        return ('Invalid sort, order or limit', None)
+    low, high = score_range_args(*ranges.get(BALANCE_INDEX, (None, None, False)))
+    return (None, score_range(BALANCE_INDEX, low, high, args.get('limit'), args.get('order') == 'desc'))
+
+# Reads the ids for ?created_after= and ?created_before=, or ?updated_since=,
+# oldest first. Returns (error, ids).
+def time_range(args):
+    error, ranges = parse_score_ranges(args)
+    if error:
+        return (error, None)
+    limit = args.get('limit')
+    if limit and not is_page_size(limit):
+        return ('Invalid limit', None)
+    index = UPDATED_INDEX if 'updated_since' in args else CREATED_INDEX
+    low, high = score_range_args(*ranges.get(index, (None, None, False)))
+    return (None, score_range(index, low, high, limit))
+
+# Reads the ids for ?name_prefix=, ordered by name, at most ?limit= of them
+# (MAX_PAGE_SIZE by default). Returns (error, ids).
+def name_prefix_range(args):
+    prefix = normalize_name(args['name_prefix'])
+    limit = args.get('limit', str(MAX_PAGE_SIZE))
+    if not is_name_prefix(prefix) or not is_page_size(limit):
+        return ('Invalid name_prefix or limit', None)
+    members = redis_server.zrangebylex(NAME_LEX_INDEX, *name_lex_range(prefix), start=0, num=int(limit))
+    return (None, [member.rsplit(':', 1)[1] for member in members])
+
+def is_name_prefix(prefix):
+    return prefix and ':' not in prefix
+
+# Every member starting with the prefix sorts below prefix + 0xff
+def name_lex_range(prefix):
+    return ('[' + prefix, '(' + prefix + '\xff')
+
+# How list_accounts reads each sorted set index
+RANGE_QUERIES = {
+    NAME_LEX_INDEX: name_prefix_range,
+    BALANCE_INDEX: balance_range,
+    CREATED_INDEX: time_range,
+    UPDATED_INDEX: time_range,
+}
+
+# The ids of a sorted set index with a score between low and high, at most
+# limit of them, in score order
+def score_range(index, low, high, limit=None, desc=False):
+    start, num = (0, int(limit)) if limit else (None, None)
+    if desc:
+        return redis_server.zrevrangebyscore(index, high, low, start=start, num=num)
+    return redis_server.zrangebyscore(index, low, high, start=start, num=num)
+
+# The query parameters of each filter GET /accounts accepts, and the account
+# field behind each exact match filter
+FILTER_PARAMS = (('name',), ('type',), ('active',), ('name_prefix',),
+                 ('min_balance', 'max_balance', 'sort'), ('created_after', 'created_before'),
+                 ('updated_since',))
+SET_FILTERS = (('name', 'name'), ('type', 'accounttype'), ('active', 'active'))
+
+def is_combined_query(args):
+    return len([params for params in FILTER_PARAMS if any(args.get(param) for param in params)]) > 1
+
+# Answers a query that combines several filters. One pipelined round trip
+# counts the ids every filter matches (SCARD, ZCOUNT, ZLEXCOUNT). Only the
+# smallest is read, with a single SINTER of all the exact match sets when
+# one of them is the smallest, and the accounts fetched for it are checked
+# against the other filters. A query then costs about the size of its most
+# selective filter instead of the size of the database. Accounts are listed
+# by id, or by balance with ?sort=balance. Returns (error, accounts).
+def combined_query(args):
+    error, ranges = parse_score_ranges(args)
+    if error:
+        return (error, None)
+    if not is_sort_valid(args):
+        return ('Invalid sort, order or limit', None)
+    prefix = normalize_name(args.get('name_prefix', ''))
+    if args.get('name_prefix') and not is_name_prefix(prefix):
+        return ('Invalid name_prefix', None)
+    sets = [(index_key(field, args[param]), field, normalize_value(args[param]))
+            for param, field in SET_FILTERS if args.get(param)]
+
+    pipe = redis_server.pipeline(transaction=False)
+    readers = []
+    for key, field, value in sets:
+        pipe.scard(key)
+        readers.append(lambda: redis_server.sinter([key for key, field, value in sets]))
+    for index, bounds in ranges.iteritems():
+        pipe.zcount(index, *score_range_args(*bounds))
+        readers.append(lambda index=index, bounds=bounds: redis_server.zrangebyscore(index, *score_range_args(*bounds)))
+    if prefix:
+        pipe.zlexcount(NAME_LEX_INDEX, *name_lex_range(prefix))
+        readers.append(lambda: [member.rsplit(':', 1)[1] for member in
+                                redis_server.zrangebylex(NAME_LEX_INDEX, *name_lex_range(prefix))])
+    sizes = pipe.execute()
+    if not sizes or min(sizes) == 0:
+        ids = [] if sizes else redis_server.zrange(ID_INDEX, 0, -1)
+    else:
+        ids = readers[sizes.index(min(sizes))]()
+
+    accounts = []
+    for account in load_accounts(ids):
+        if all(account.get(field) == value for key, field, value in sets) \
+                and all(in_score_range(INDEX_SCORES[index](account), *bounds) for index, bounds in ranges.iteritems()) \
+                and normalize_name(account['name']).startswith(prefix):
+            accounts.append(account)
+    if 'sort' in args:
+        accounts.sort(key=INDEX_SCORES[BALANCE_INDEX], reverse=args.get('order') == 'desc')
+    if args.get('limit'):
+        accounts = accounts[:int(args['limit'])]
+    return (None, [decode_account(account) for account in accounts])
+
+# Queue the writes for a new account and its index entries on a pipeline
+def queue_account(pipe, account):
+    pipe.hmset(account['id'], account_to_hash(account))
+    add_to_indexes(pipe, account)
+
+# Fetch many accounts in one round trip, skipping ids that no longer exist.
+# They are sorted by id unless in_order is set. With STORE_ACCOUNT_JSON they
+# are returned as their stored JSON.
+def fetch_accounts(ids, in_order=False):
+    if STORE_ACCOUNT_JSON:
+        return fetch_accounts_json(ids, in_order)
+    return [decode_account(account) for account in load_accounts(ids, in_order)]
+
+# Same as fetch_accounts, but the accounts are returned as stored
+def load_accounts(ids, in_order=False):
+    ids = ids if in_order else sorted(ids, key=int)
+    pipe = redis_server.pipeline(transaction=False)
+    for id in ids:
+        pipe.hgetall(id)
+    return [account_from_hash(id, fields) for id, fields in zip(ids, pipe.execute()) if fields]
+
+# SCAN the whole database and yield the account ids a chunk at a time
+def iter_account_id_chunks(chunk_size=1000):
+    ids = []
+    for key in redis_server.scan_iter(count=chunk_size):
+        if is_account_key(key):
+            ids.append(key)
+        if len(ids) == chunk_size:
+            yield ids
+            ids = []
+    if ids:
+        yield ids
+
+# Walk index:id in batches, so the whole id list is never held in memory
+def iter_all_ids(batch_size=None):
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    min_id = '-inf'
+    while True:
+        ids = redis_server.zrangebyscore(ID_INDEX, min_id, '+inf', start=0, num=batch_size)
+        for id in ids:
+            yield id
+        if len(ids) < batch_size:
+            return
+        min_id = '(%s' % ids[-1]
+
+# SSCAN may return an id more than once while the set is rehashed, so the
+# ids already seen are skipped. Only the ids of one set are kept, never the
+# accounts.
+def unique(ids):
+    seen = set()
+    for id in ids:
+        if id not in seen:
+            seen.add(id)
+            yield id
+
+# Fetch the accounts for a stream of ids one pipelined batch at a time
+def iter_accounts(ids, batch_size=None):
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    batch = []
+    for id in ids:
+        batch.append(id)
+        if len(batch) == batch_size:
+            for account in fetch_accounts(batch):
+                yield account
+            batch = []
+    for account in fetch_accounts(batch):
+        yield account
+
+# Rebuild every index from the account hashes, e.g. for data written
+# before the indexes existed. Run it with: python manage.py rebuild-indexes
+def rebuild_indexes(chunk_size=1000):
+    pipe = redis_server.pipeline(transaction=False)
+    for key in redis_server.scan_iter(match=INDEX_PREFIX + '*', count=chunk_size):
+        pipe.delete(key)
+    pipe.delete(STATS_KEY)
+    pipe.execute()
+    count = 0
+    for ids in iter_account_id_chunks(chunk_size):
+        accounts = load_accounts(ids)
+        for account in accounts:
+            add_to_indexes(pipe, account)
+        pipe.execute()
+        count += len(accounts)
+    return count
+
+# Convert accounts written by older versions to the compact hashes, e.g.
+# hashes with long field names, balances stored as "10.00" or times stored
+# as "2016-12-01 10:00:00". The database is read a SCAN chunk at a time and
+# every chunk is rewritten by one script, which skips accounts that were
+# changed or deleted since they were read, so it can run while the service
+# is up. progress(scanned, migrated) is called after every chunk.
+# Run it with: python manage.py migrate
+def migrate_accounts(chunk_size=1000, progress=None):
+    pipe = redis_server.pipeline(transaction=False)
+    scanned = 0
+    migrated = 0
+    for ids in iter_account_id_chunks(chunk_size):
+        for id in ids:
+            pipe.hget(ACCOUNT_VERSIONS, id)
+            pipe.hgetall(id)
+        replies = pipe.execute()
+        args = []
+        for id, version, fields in zip(ids, replies[::2], replies[1::2]):
+            hash = account_to_hash(account_from_hash(id, fields)) if fields else fields
+            if hash != fields:
+                pairs = [item for field_value in hash.iteritems() for item in field_value]
+                args.extend([id, version or '', len(pairs)] + pairs)
+        if args:
+            migrated += migrate_hashes_script(args=args)
+        scanned += len(ids)
+        if progress:
+            progress(scanned, migrated)
+    return migrated
+
+# Bytes per account: as stored, and with the hashes of a sample of the
+# accounts written with long field names (as before the compact hashes) and
+# compact, both measured on scratch copies with MEMORY USAGE. The copies of
+# an account are stored under its id with every digit replaced by a letter,
+# so their keys take as many bytes as the id and are never account keys.
+# used_memory per account includes the indexes, stats and stored JSON.
+# Run it with: python manage.py memory-report
+SCRATCH_DIGITS = (string.maketrans('0123456789', 'abcdefghij'), string.maketrans('0123456789', 'klmnopqrst'))
+
+def memory_report(sample_size=1000):
+    ids = next(iter_account_id_chunks(sample_size), [])
+    accounts = load_accounts(ids)
+    pipe = redis_server.pipeline(transaction=False)
+    for account in accounts:
+        long_key, compact_key = [account['id'].translate(digits) for digits in SCRATCH_DIGITS]
+        hash = account_to_hash(account)
+        # what older versions stored: every field by name, and the id
+        pipe.hmset(long_key, dict([(FIELD_NAMES[code], value) for code, value in hash.iteritems()],
+                                  id=account['id']))
+        pipe.hmset(compact_key, hash)
+        for key in (account['id'], long_key, compact_key):
+            pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', '0')
+        pipe.delete(long_key, compact_key)
+    # six replies per account, the usages are the third to fifth
+    replies = pipe.execute()
+    sampled = float(len(accounts) or 1)
+    count = load_stats()['count']
+    return {
+        'accounts': count,
+        'sampled': len(accounts),
+        'stored': sum(replies[2::6]) / sampled,
+        'long_field_names': sum(replies[3::6]) / sampled,
+        'compact': sum(replies[4::6]) / sampled,
+        'used_memory_per_account': redis_server.info('memory')['used_memory'] / float(count or 1),
+    }
+
+######################################################################
+#  S T A T I S T I C S
+######################################################################
+# Totals are kept in the stats:accounts hash and changed by every write,
+# next to the indexes, so GET /accounts/stats is a single HGETALL:
+#   count, balance                       all accounts
+#   count:active:<value>                 accounts per active value
+#   count:accounttype:<type>             accounts per type
+#   balance:accounttype:<type>           balance in cents per type
+STATS_KEY = 'stats:accounts'
+
+def stats_fields(account):
+    return {
+        'count' : 1,
+        'balance' : stored_cents(account['balance']),
+        'count:active:%s' % account['active'] : 1,
+        'count:accounttype:%s' % account['accounttype'] : 1,
+        'balance:accounttype:%s' % account['accounttype'] : stored_cents(account['balance']),
+    }
+
+# Adds (sign 1) or removes (sign -1) an account from the totals
+def queue_stats(pipe, account, sign):
+    for field, amount in stats_fields(account).iteritems():
+        pipe.hincrby(STATS_KEY, field, sign * amount)
+
+def load_stats():
+    stats = dict((field, int(value)) for field, value in redis_server.hgetall(STATS_KEY).iteritems())
+    return {
+        'count' : stats.get('count', 0),
+        'balance' : format_cents(stats.get('balance', 0)),
+        'active' : dict((value, stats.get('count:active:' + value, 0)) for value in ('true', 'false')),
+        'accounttype' : dict((str(type), {
+            'count' : stats.get('count:accounttype:%d' % type, 0),
+            'balance' : format_cents(stats.get('balance:accounttype:%d' % type, 0)),
+        }) for type in ACCOUNT_TYPES),
+    }
+
+# Recompute the totals from the account hashes, e.g. after they drifted or
+# for data written before they existed. Run it with: python manage.py rebuild-stats
+def rebuild_stats(chunk_size=1000):
+    stats = {}
+    count = 0
+    for ids in iter_account_id_chunks(chunk_size):
+        for account in load_accounts(ids):
+            for field, amount in stats_fields(account).iteritems():
+                stats[field] = stats.get(field, 0) + amount
+            count += 1
+    pipe = redis_server.pipeline()
+    pipe.delete(STATS_KEY)
+    if stats:
+        pipe.hmset(STATS_KEY, stats)
+    pipe.execute()
+    return count
+
+######################################################################
+#  A C C O U N T   C A C H E   I N V A L I D A T I O N
+######################################################################
+# Marks an account as changed: bumps the version its ETag is built from
+# and tells every process to drop it from its cache
+def queue_invalidation(pipe, id, deleted=False):
+    if deleted:
+        pipe.hdel(ACCOUNT_VERSIONS, id)
+    else:
+        pipe.hincrby(ACCOUNT_VERSIONS, id, 1)
+    pipe.publish(ACCOUNT_INVALIDATION_CHANNEL, id)
+
+# Runs in a daemon thread and drops every account another process changed.
+# If the subscription breaks, updates may have been missed, so the whole
+# cache is cleared while it reconnects.
+def listen_for_invalidations(pubsub):
+    while True:
+        try:
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    account_cache.evict(message['data'])
+        except RedisError:
+            account_cache.clear()
+            time.sleep(1)
+
+def start_invalidation_listener():
+    global invalidation_listener
+    if not account_cache.enabled or invalidation_listener:
+        return
+    # the subscription waits for messages indefinitely, so it gets its own
+    # connection without the pool's socket timeout
+    connection_kwargs = dict(redis_server.connection_pool.connection_kwargs, socket_timeout=None)
+    pubsub = redis.Redis(connection_pool=redis.ConnectionPool(**connection_kwargs)).pubsub()
+    pubsub.subscribe(ACCOUNT_INVALIDATION_CHANNEL)
+    invalidation_listener = threading.Thread(target=listen_for_invalidations, args=(pubsub,))
+    invalidation_listener.daemon = True
+    invalidation_listener.start()
+
+######################################################################
+#  R E Q U E S T   M E T R I C S
+######################################################################
+# Every request is timed and charged with the Redis commands it issues,
+# counted by the InstrumentedRedis client, under its route pattern, e.g.
+# /accounts/<id>. Commands issued while a streamed reply is being sent are
+# not charged to it. They are served on /metrics. Requests are recorded on
+# teardown, which also runs when a view raises and Flask answers with a 500
+# without calling the after_request hooks.
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def record_metrics_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.finish_request(route, request.method, getattr(g, 'metrics_status', 500))
+
+# Opt-in profiles of slow requests, see profiling.py
+request_profiler = profiler_from_environment()
+request_profiler.install(app)
+
+# Gauges and counters kept outside the metrics module
+def process_metrics():
+    pool = redis_pool_stats()
+    cache = account_cache.stats()
+    return {
+        'redis_pool_connections': ('gauge', 'Connections of the Redis pool.', {
+            (('state', 'in_use'),): pool['in_use_connections'],
+            (('state', 'idle'),): pool['idle_connections'],
+            (('state', 'max'),): pool['max_connections'],
+        }),
+        'account_cache_entries': ('gauge', 'Accounts in the cache.', {(): cache['size']}),
+        'account_cache_lookups_total': ('counter', 'Account cache lookups.', {
+            (('result', 'hit'),): cache['hits'],
+            (('result', 'miss'),): cache['misses'],
+        }),
+    }
+
+metrics.extra = process_metrics
+
+######################################################################
+#  L U A   S C R I P T S
+######################################################################
+# Allocates the next account id and replays the commands queued on a
+# pipeline with every ID_PLACEHOLDER replaced by that id, so a new account
+# and its index entries are written atomically in a single round trip.
+# Names may only contain letters and spaces, so the placeholder can never
+# collide with account data.
+ID_PLACEHOLDER = '{id}'
+
+CREATE_ACCOUNT_LUA = """
+local id = tostring(redis.call('HINCRBY', KEYS[1], 'nextId', 1) - 1)
+local i = 1
+while i <= #ARGV do
+    local n = tonumber(ARGV[i])
+    local command = {}
+    for j = 1, n do
+        command[j] = (string.gsub(ARGV[i + j], '{id}', id))
+    end
+    redis.call(unpack(command))
+    i = i + n + 1
+end
+return id
+"""
+
+# The largest balance or amount in cents. Lua numbers are doubles, which
+# hold every integer up to it exactly, and the totals in stats:accounts
+# stay far from the 64-bit limit of HINCRBY.
+MAX_CENTS = 2 ** 53 - 1
+
+# Lua helpers shared by the scripts that move money. check_account returns
+# why an account cannot take part, if it cannot. adjust_balance changes the
+# balance and keeps everything derived from the account in sync, as
+# add_to_indexes and queue_invalidation do for the other writes.
+BALANCE_LUA_FUNCTIONS = """
+local function check_account(id)
+    local account = redis.call('HMGET', id, '%(balance)s', '%(active)s')
+    if not account[1] then
+        -- a hash with the field names of an older version
+        if redis.call('EXISTS', id) == 1 then
+            return 'unmigrated'
+        end
+        return 'missing'
+    end
+    if account[2] ~= 'true' then
+        return 'inactive'
+    end
+    return nil
+end
+
+-- cents is passed as the string from ARGV, a number would be formatted as
+-- 1e+15 from 15 digits on, which HINCRBY refuses
+local function adjust_balance(id, cents, updated_time)
+    local balance = redis.call('HINCRBY', id, '%(balance)s', cents)
+    redis.call('HSET', id, '%(last_updated_time)s', updated_time)
+    redis.call('ZADD', '%(updated_index)s', updated_time, id)
+    redis.call('ZADD', '%(balance_index)s', string.format('%%d', balance), id)
+    local indexes = {%(account_indexes)s}
+    for i = 1, #indexes do
+        redis.call('HINCRBY', '%(index_generations)s', indexes[i], 1)
+    end
+    local fields = {%(indexed_fields)s}
+    for field, code in pairs(fields) do
+        local key = '%(index_prefix)s' .. field .. ':' .. redis.call('HGET', id, code)
+        redis.call('HINCRBY', '%(index_generations)s', key, 1)
+    end
+    local accounttype = redis.call('HGET', id, '%(accounttype)s')
+    redis.call('HINCRBY', '%(stats)s', 'balance', cents)
+    redis.call('HINCRBY', '%(stats)s', 'balance:accounttype:' .. accounttype, cents)
+    redis.call('HINCRBY', '%(account_versions)s', id, 1)
+    redis.call('DEL', '%(json_prefix)s' .. id)
+    redis.call('PUBLISH', '%(channel)s', id)
+    return balance
+end
+""" % {
+    'indexed_fields': ', '.join("%s = '%s'" % (field, FIELD_CODES[field]) for field in INDEXED_FIELDS),
+    'balance': FIELD_CODES['balance'],
+    'active': FIELD_CODES['active'],
+    'accounttype': FIELD_CODES['accounttype'],
+    'last_updated_time': FIELD_CODES['last_updated_time'],
+    'index_prefix': INDEX_PREFIX,
+    'index_generations': INDEX_GENERATIONS,
+    'account_indexes': ', '.join("'%s'" % index for index in ACCOUNT_INDEXES),
+    'balance_index': BALANCE_INDEX,
+    'updated_index': UPDATED_INDEX,
+    'account_versions': ACCOUNT_VERSIONS,
+    'stats': STATS_KEY,
+    'json_prefix': JSON_PREFIX,
+    'channel': ACCOUNT_INVALIDATION_CHANNEL,
+}
+
+# Deposits (positive cents) or withdraws (negative cents) without letting
+# the balance go below zero. ARGV is id, cents, last_updated_time.
+CHANGE_BALANCE_LUA = BALANCE_LUA_FUNCTIONS + """
+local id, cents = ARGV[1], tonumber(ARGV[2])
+local error = check_account(id)
+if error then
+    return {error, id}
+end
+local balance = tonumber(redis.call('HGET', id, '%(balance)s'))
+if balance + cents < 0 then
+    return {'insufficient_funds', id}
+end
+if balance + cents > %(max_cents)d then
+    return {'balance_too_large', id}
+end
+return {'ok', adjust_balance(id, ARGV[2], ARGV[3])}
+""" % {'balance': FIELD_CODES['balance'], 'max_cents': MAX_CENTS}
+
+# Moves money between two accounts, all or nothing. ARGV is from, to,
+# cents, last_updated_time.
+TRANSFER_LUA = BALANCE_LUA_FUNCTIONS + """
+local from, to, cents = ARGV[1], ARGV[2], tonumber(ARGV[3])
+for _, id in ipairs({from, to}) do
+    local error = check_account(id)
+    if error then
+        return {error, id}
+    end
+end
+if tonumber(redis.call('HGET', from, '%(balance)s')) < cents then
+    return {'insufficient_funds', from}
+end
+if tonumber(redis.call('HGET', to, '%(balance)s')) + cents > %(max_cents)d then
+    return {'balance_too_large', to}
+end
+return {'ok', adjust_balance(from, '-' .. ARGV[3], ARGV[4]), adjust_balance(to, ARGV[3], ARGV[4])}
+""" % {'balance': FIELD_CODES['balance'], 'max_cents': MAX_CENTS}
+
+# Stores the JSON of accounts read from their hashes, unless they changed
+# since. ARGV is id, version, json for every account.
+STORE_JSON_LUA = """
+for i = 1, #ARGV, 3 do
+    if redis.call('HGET', '%(account_versions)s', ARGV[i]) == ARGV[i + 1] then
+        redis.call('SET', '%(json_prefix)s' .. ARGV[i], ARGV[i + 2])
+    end
+end
+""" % {
+    'account_versions': ACCOUNT_VERSIONS,
+    'json_prefix': JSON_PREFIX,
+}
+
+# Replaces account hashes read by migrate_accounts, unless the account was
+# changed or deleted since, and drops their stored JSON. ARGV is id,
+# version, number of field and value arguments, fields and values for
+# every account. Returns the number of accounts replaced.
+MIGRATE_HASHES_LUA = """
+local migrated = 0
+local i = 1
+while i <= #ARGV do
+    local id, version, n = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+    if redis.call('EXISTS', id) == 1 and (redis.call('HGET', '%(account_versions)s', id) or '') == version then
+        redis.call('DEL', id, '%(json_prefix)s' .. id)
+        redis.call('HMSET', id, unpack(ARGV, i + 3, i + 2 + n))
+        migrated = migrated + 1
+    end
+    i = i + n + 3
+end
+return migrated
+""" % {
+    'account_versions': ACCOUNT_VERSIONS,
+    'json_prefix': JSON_PREFIX,
+}
+
+# Why a script refused to move money, as an HTTP reply
+BALANCE_ERRORS = {
+    'missing': (HTTP_404_NOT_FOUND, 'Account id: %s is not found'),
+    'inactive': (HTTP_403_ACCESS_FORBIDDEN, 'Account id: %s is not active'),
+    'insufficient_funds': (HTTP_409_CONFLICT, 'Insufficient funds in account id: %s'),
+    'balance_too_large': (HTTP_409_CONFLICT, 'The balance of account id: %s would exceed the maximum'),
+    'unmigrated': (HTTP_409_CONFLICT, 'Account id: %s is stored in a legacy format, run python manage.py migrate'),
+}
+
+# The scripts are loaded up front, so the first request to run each one
+# does not pay two extra round trips for NOSCRIPT and SCRIPT LOAD
+def register_scripts():
+    global create_account_script, change_balance_script, transfer_script, store_json_script, migrate_hashes_script
+    create_account_script = redis_server.register_script(CREATE_ACCOUNT_LUA)
+    change_balance_script = redis_server.register_script(CHANGE_BALANCE_LUA)
+    transfer_script = redis_server.register_script(TRANSFER_LUA)
+    store_json_script = redis_server.register_script(STORE_JSON_LUA)
+    migrate_hashes_script = redis_server.register_script(MIGRATE_HASHES_LUA)
+    for script in (create_account_script, change_balance_script, transfer_script, store_json_script,
+                   migrate_hashes_script):
+        script.sha = redis_server.script_load(script.script)
+
+# Returns the id the commands were executed with
+def execute_with_next_id(pipe):
+    args = []
+    for command, options in pipe.command_stack:
+        args.append(len(command))
+        args.extend(command)
+    pipe.reset()
+    return create_account_script(keys=['nextId'], args=args)
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
-def reply(message, rc):
-    response = Response(json.dumps(message))
+def reply(message, rc, etag=None):
+    response = Response(dumps(message))
     response.headers['Content-Type'] = 'application/json'
     response.status_code = rc
+    if etag:
+        response.set_etag(etag)
+    return response
+
+def not_modified(etag):
+    response = Response(status=HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
     return response
 
+def account_etag(version):
+    return 'v%s' % (version or '0')
+
+# Tags a list with the query and the generation of the index it reads
+def list_etag(key):
+    generation = redis_server.hget(INDEX_GENERATIONS, key) or '0'
+    query = '%s|%s|%s' % (request.query_string, wants_stream(), generation)
+    return hashlib.md5(query).hexdigest()
+
+# Writes one JSON account per line while the accounts are still being fetched
+def stream_reply(accounts, etag=None):
+    lines = (dumps(account) + '\n' for account in accounts)
+    response = Response(lines)
+    response.headers['Content-Type'] = NDJSON_CONTENT_TYPE
+    response.status_code = HTTP_200_OK
+    if etag:
+        response.set_etag(etag)
+    return response
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best == NDJSON_CONTENT_TYPE
+
+# Validates a create payload. Returns (errors, account), where account is
+# the new account without its id
+def build_account(payload):
+    errors, values = validate_account(payload)
+    if errors:
+        return (errors, None)
+
+    created_time = current_time()
+    account = {
+        'name': values['name'],
+        'balance': values['balance'],
+        'active': values['active'],
+        'created_time': created_time,
+        'last_updated_time': created_time,
+        #assign 0 as a default value if payload does not contain accounttype
+        'accounttype': values.get('accounttype', '0'),
+    }
+    return (None, account)
+
+# Epoch seconds, as stored
+def current_time():
+    return int(time.time())
+
+# Applies a deposit (sign 1) or a withdrawal (sign -1) in one round trip
+def change_balance(id, sign):
+    payload = []
+    try:
+        payload = json.loads(request.data)
+    except Exception as err:
+        return reply({'error' : format(err)}, HTTP_400_BAD_REQUEST)
+    error, cents = parse_amount(payload)
+    if error:
+        return reply({'error' : error}, HTTP_400_BAD_REQUEST)
+    if not is_account_key(id):
+        return reply({'error' : BALANCE_ERRORS['missing'][1] % id}, HTTP_404_NOT_FOUND)
+
+    result = change_balance_script(args=[id, sign * cents, current_time()])
+    account_cache.evict(id)
+    if result[0] != 'ok':
+        return balance_error_reply(result)
+    return reply({ 'id' : id, 'balance' : format_cents(result[1]) }, HTTP_200_OK)
+
+# Replies to a balance script that returned [reason, id]
+def balance_error_reply(result):
+    rc, error = BALANCE_ERRORS[result[0]]
+    return reply({'error' : error % result[1]}, rc)
+
+# Returns (error, cents) for the amount of a deposit, withdrawal or transfer
+def parse_amount(payload):
+    if not isinstance(payload, dict) or 'amount' not in payload:
+        return ('Missing or invalid amount', None)
+    error, cents = parse_cents(payload['amount'], 'amount')
+    if not error and cents == 0:
+        error = 'Amount must be greater than zero'
+    return (error, cents)
+
+# An id sent in a JSON body, as a string: integers are converted and
+# strings kept as they are, so ids that are not account keys can be
+# reported as not found. None for any other value.
+def json_id(value):
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+def invalid_reply(errors):
+    return reply({ 'error' : errors[0], 'errors' : errors }, HTTP_400_BAD_REQUEST)
+
+######################################################################
+#  V A L I D A T I O N
+######################################################################
 # NEED THREE FIELDS TO BE NOT NULL: name, balance, active
-def find_missing_params(data):
-    missing_params = []
-    if not data.has_key('active'):
-        missing_params.append('active')
-    if not data.has_key('balance'):
-        missing_params.append('balance')
-    if not data.has_key('name'):
-        missing_params.append('name')
-    if data.has_key('accounttype'):
-        if data['accounttype'] not in {0,1,2,3}:
-            missing_params.append('accounttype')
-    return missing_params
+REQUIRED_FIELDS = ('active', 'balance', 'name')
+READ_ONLY_FIELDS = ('created_time', 'last_updated_time')
+ACCOUNT_TYPES = (0, 1, 2, 3)
+ACTIVE_VALUES = { 'true' : 'true', 't' : 'true', '1' : 'true',
+                  'false' : 'false', 'f' : 'false', '0' : 'false' }
+# sign, integer part with optional thousands separators, decimals
+BALANCE_PATTERN = re.compile(r'^(-)?(\d{1,3}(?:,\d{1,3})+|\d+)(?:\.(\d+))?$')
+# words of letters separated by single spaces
+NAME_PATTERN = re.compile(r'^[^\W\d_]+( [^\W\d_]+)*$', re.UNICODE)
 
-# Returns a list - first element is whether it passed validation, second is message, third is transformed data
-def validate_balance(balance):
-    balance = str(balance)
+# Checks a create or update payload in one pass. Returns (errors, values),
+# where errors lists every problem found and values holds the normalized
+# name, balance, active and accounttype
+def validate_account(payload, update=False):
+    if not isinstance(payload, dict):
+        return (['Account must be a JSON object'], {})
+    errors = []
+    values = {}
 
-    is_a_number = re.compile("^(-)?((((\d){1,3},(\d){1,3})+(,(\d){1,3})?(\.(\d)+)?)|((\d)+(\.)*(\d)+)|(\d)+)$")
+    missing_params = [field for field in REQUIRED_FIELDS if field not in payload]
+    if 'accounttype' in payload:
+        # true == 1 and 1.0 == 1 in Python, but only integers are types
+        accounttype = payload['accounttype']
+        if isinstance(accounttype, (int, long)) and not isinstance(accounttype, bool) \
+                and accounttype in ACCOUNT_TYPES:
+            values['accounttype'] = str(accounttype)
+        else:
+            missing_params.append('accounttype')
+    if missing_params:
+        errors.append('Missing or invalid %s' % missing_params)
 
-    if is_a_number.match(balance):
-        is_negative = re.compile("^-(.)*$")
+    if update:
+        for field in READ_ONLY_FIELDS:
+            if field in payload:
+                errors.append('Field %s is not allowed to change' % field)
 
-        if is_negative.match(balance):
-            return ('false', 'Negative values not allowed in balance parameter', balance)
+    if 'balance' in payload:
+        error, values['balance'] = parse_cents(payload['balance'])
+        if error:
+            errors.append(error)
 
-        too_many_decimals = re.compile("^(\d)*\.(\d){3,}$")
+    if 'active' in payload:
+        values['active'] = ACTIVE_VALUES.get(unicode(payload['active']).lower())
+        if values['active'] is None:
+            errors.append('Not a valid value for active parameter')
 
-        if too_many_decimals.match(balance):
-            return ('false', 'More than two digits after the decimal in balance parameter', balance)
+    if 'name' in payload:
+        values['name'] = payload['name']
+        if not isinstance(values['name'], basestring) or not NAME_PATTERN.match(values['name']):
+            errors.append('Invalid name.')
 
-        if ',' in balance:
-            balance = re.sub(',', '', balance)
+    return (errors, values)
 
-        is_an_int = re.compile("^(\d+)$")
+# Returns (error, cents) for an amount such as 1,000.5. Strings are matched
+# as they are, str() would fail on non-ASCII unicode.
+def parse_cents(balance, field='balance'):
+    match = BALANCE_PATTERN.match(balance if isinstance(balance, basestring) else str(balance))
+    if not match:
+        return ('Not a valid number for %s parameter' % field, None)
+    negative, whole, decimals = match.groups()
+    if negative:
+        return ('Negative values not allowed in %s parameter' % field, None)
+    if decimals and len(decimals) > 2:
+        return ('More than two digits after the decimal in %s parameter' % field, None)
+    cents = int(whole.replace(',', '')) * 100 + int((decimals or '').ljust(2, '0'))
+    if cents > MAX_CENTS:
+        return ('Value too large for %s parameter, the most is %s' % (field, format_cents(MAX_CENTS)), None)
+    return (None, cents)
 
-        if is_an_int.match(balance):
-            balance += '.0'
+# Accepts epoch seconds or a time in the format the API returns
+def parse_time(value, field):
+    if DIGITS_PATTERN.match(value):
+        return (None, int(value))
+    try:
+        shifted = datetime.datetime.strptime(value, TIME_FORMAT) + datetime.timedelta(hours=TIME_SHIFT_HOURS)
+    except (ValueError, OverflowError):
+        return ('Not a valid time for %s parameter' % field, None)
+    return (None, int(time.mktime(shifted.timetuple())))
 
-        too_few_decimals = re.compile("^(\d)*\.\d$")
+def format_cents(cents):
+    return '%d.%02d' % divmod(int(cents), 100)
 
-        if too_few_decimals.match(balance):
-            balance += '0'
+######################################################################
+#  S T O R A G E   F O R M A T
+######################################################################
+# An account is stored as a hash under its id with one letter per field,
+# see FIELD_CODES, and without the id, e.g. {n: Gina, b: 1050, t: 0,
+# a: true, c: 1480000000, u: 1480000000}. Balances are stored as integer
+# cents so they can be changed atomically with HINCRBY, and times as epoch
+# seconds so they can be indexed by time; Redis keeps both as integers in
+# the packed encoding of small hashes. account_from_hash and
+# account_to_hash are the only places that know the field codes, everything
+# else works with accounts by field name, as stored. decode_account turns
+# a stored account into the JSON the API returns, with times as local time
+# shifted by TIME_SHIFT_HOURS like they always were.
+# Hashes written by older versions, with the field names, "10.00" balances
+# or formatted times, are still read and returned as they are until
+# python manage.py migrate converts them, and every update rewrites them.
+TIME_FIELDS = ('created_time', 'last_updated_time')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIME_SHIFT_HOURS = 5
 
-        return ("true", "processed", balance)
+# The account in a hash read from Redis, {} when there is none
+def account_from_hash(id, fields):
+    if not fields:
+        return {}
+    if FIELD_CODES['balance'] in fields:
+        account = dict((FIELD_NAMES.get(code, code), value) for code, value in fields.iteritems())
     else:
-        return ('false', 'Not a valid number for balance parameter', balance)
+        account = dict(fields)
+    account['id'] = id
+    return account
+
+# The key of a field in a hash as read, its name in a hash written by an
+# older version
+def stored_field(fields, field):
+    return FIELD_CODES[field] if FIELD_CODES['balance'] in fields else field
+
+def account_to_hash(account):
+    hash = dict((FIELD_CODES[field], value) for field, value in account.iteritems() if field in FIELD_CODES)
+    hash[FIELD_CODES['balance']] = str(stored_cents(account['balance']))
+    for field in TIME_FIELDS:
+        if field in account:
+            hash[FIELD_CODES[field]] = str(stored_time(account[field]))
+    return hash
+
+def read_account(id):
+    return account_from_hash(id, redis_server.hgetall(id))
+
+# Reads an account and queues write(pipe, account, fields) in a MULTI, with
+# the hash as read in fields, while the hash is WATCHed. When another client changes the account before EXEC,
+# nothing is written and it is read again, so the indexes and stats are
+# always updated from the account as it is stored, and a balance changed
+# in between is never written back. Returns the account as write left it,
+# {} when it does not exist, and None when it kept changing for
+# WRITE_ATTEMPTS reads, after waiting a random time of up to
+# WRITE_BACKOFF_SECONDS, doubled on every attempt, before each read again.
+WRITE_ATTEMPTS = 10
+WRITE_BACKOFF_SECONDS = 0.001
+BUSY_ERROR = 'Account id: %s is changing too often, try again'
+
+def write_account(id, write):
+    with redis_server.pipeline() as pipe:
+        for attempt in range(WRITE_ATTEMPTS):
+            if attempt:
+                time.sleep(random.random() * WRITE_BACKOFF_SECONDS * 2 ** attempt)
+            try:
+                pipe.watch(id)
+                fields = pipe.hgetall(id)
+                account = account_from_hash(id, fields)
+                if not account:
+                    return {}
+                pipe.multi()
+                write(pipe, account, fields)
+                pipe.execute()
+                return account
+            except WatchError:
+                continue
+    return None
 
+# Queue replacing the hash of an account, which drops the field names of a
+# hash written by an older version
+def queue_hash(pipe, account):
+    pipe.delete(account['id'])
+    pipe.hmset(account['id'], account_to_hash(account))
 
-# Returns a list - first element is whether it passed validation, second is message, third is transformed data
-def validate_active(active):
-    active = str(active).lower()
+def decode_account(account):
+    account = dict(account)
+    if '.' not in str(account['balance']):
+        account['balance'] = format_cents(account['balance'])
+    for field in TIME_FIELDS:
+        if str(account.get(field)).isdigit():
+            account[field] = format_time(account[field])
+    return account
 
-    if (active == 'true' or active == 't' or active == '1'):
-        return ('true', 'valid', 'true')
-    elif (active == 'false' or active == 'f' or active == '0'):
-        return ('true', 'valid', 'false')
+def format_time(epoch):
+    shifted = datetime.datetime.fromtimestamp(int(epoch)) - datetime.timedelta(hours=TIME_SHIFT_HOURS)
+    return shifted.strftime(TIME_FORMAT)
 
-    return ('false', 'Not a valid value for active parameter', active)
+def stored_time(value):
+    return parse_time(str(value), 'time')[1]
+
+def stored_cents(balance):
+    if '.' in str(balance):
+        return parse_cents(balance)[1]
+    return int(balance)
+
+######################################################################
+#  P R E - S E R I A L I Z E D   A C C O U N T S
+######################################################################
+# With STORE_ACCOUNT_JSON=true every write also stores the JSON the API
+# returns for an account under json:<id>. Reads fetch it with GET or MGET
+# and reply() sends the bytes as they are, instead of building a dict for
+# every account and encoding it again. Every change to an account drops
+# the copy and the balance scripts only drop it, so a missing copy is
+# rebuilt from the hash by the next read, unless the account changed since.
+class SerializedJSON(str):
+    pass
+
+def json_key(id):
+    return JSON_PREFIX + str(id)
+
+# The version of an account and the account, {} when it does not exist
+def load_account(id):
+    pipe = redis_server.pipeline()
+    if STORE_ACCOUNT_JSON:
+        pipe.hget(ACCOUNT_VERSIONS, id)
+        pipe.get(json_key(id))
+        version, document = pipe.execute()
+        if document is not None:
+            return [version, SerializedJSON(document)]
+    pipe.hget(ACCOUNT_VERSIONS, id)
+    pipe.hgetall(id)
+    version, fields = pipe.execute()
+    account = account_from_hash(id, fields)
+    if not account:
+        return [version, {}]
+    if STORE_ACCOUNT_JSON:
+        return [version, store_json([(id, version, account)])[0]]
+    return [version, decode_account(account)]
+
+def fetch_accounts_json(ids, in_order=False):
+    ids = ids if in_order else sorted(ids, key=int)
+    documents = redis_server.mget([json_key(id) for id in ids]) if ids else []
+    missing = [id for id, document in zip(ids, documents) if document is None]
+    if missing:
+        pipe = redis_server.pipeline(transaction=False)
+        for id in missing:
+            pipe.hget(ACCOUNT_VERSIONS, id)
+            pipe.hgetall(id)
+        replies = pipe.execute()
+        found = [(id, version, account_from_hash(id, fields))
+                 for id, version, fields in zip(missing, replies[::2], replies[1::2]) if fields]
+        rebuilt = dict(zip([id for id, version, account in found], store_json(found)))
+        documents = [document if document is not None else rebuilt.get(id) for id, document in zip(ids, documents)]
+    return [SerializedJSON(document) for document in documents if document is not None]
+
+# Encodes accounts read from their hashes and stores the JSON of those that
+# did not change since they were read, given as (id, version, account)
+def store_json(accounts):
+    documents = [SerializedJSON(json.dumps(decode_account(account))) for id, version, account in accounts]
+    args = []
+    for (id, version, account), document in zip(accounts, documents):
+        args.extend([id, version or '', document])
+    if args:
+        store_json_script(args=args)
+    return documents
+
+# json.dumps that copies SerializedJSON into the output as it is
+def dumps(message):
+    if not STORE_ACCOUNT_JSON:
+        return json.dumps(message)
+    if isinstance(message, SerializedJSON):
+        return message
+    if isinstance(message, list):
+        return '[' + ', '.join(dumps(item) for item in message) + ']'
+    if isinstance(message, dict):
+        return '{' + ', '.join('%s: %s' % (json.dumps(key), dumps(value)) for key, value in message.iteritems()) + '}'
+    return json.dumps(message)
 
 ######################################################################
 # Connect to Redis and catch connection exceptions
+# The connection pool is tuned through the environment (or the env section
+# of manifest.yml on Bluemix):
+#   REDIS_MAX_CONNECTIONS        most connections a process opens (50)
+#   REDIS_POOL_TIMEOUT           seconds to wait for a free connection (5)
+#   REDIS_SOCKET_TIMEOUT         seconds to wait for a reply (5)
+#   REDIS_SOCKET_CONNECT_TIMEOUT seconds to wait for a connection (2)
+#   REDIS_SOCKET_KEEPALIVE       send TCP keepalives (true)
+#   REDIS_RETRY_ON_TIMEOUT       retry a command once after a timeout (false).
+#                                Only for read-only clients: a script or MULTI
+#                                that timed out after it ran would run twice.
+#   REDIS_DB                     database number (0)
 ######################################################################
+def redis_pool_settings():
+    return {
+        'db': int(os.getenv('REDIS_DB', '0')),
+        'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+        'timeout': float(os.getenv('REDIS_POOL_TIMEOUT', '5')),
+        'socket_timeout': float(os.getenv('REDIS_SOCKET_TIMEOUT', '5')),
+        'socket_connect_timeout': float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', '2')),
+        'socket_keepalive': os.getenv('REDIS_SOCKET_KEEPALIVE', 'true').lower() == 'true',
+        'retry_on_timeout': os.getenv('REDIS_RETRY_ON_TIMEOUT', 'false').lower() == 'true',
+    }
+
 def connect_to_redis(hostname, port, password):
     try:
-        redis_server = redis.Redis(host=hostname, port=port, password=password)
+        # requests wait for a free connection instead of opening more
+        pool = redis.BlockingConnectionPool(host=hostname, port=port, password=password, **redis_pool_settings())
+        redis_server = InstrumentedRedis(connection_pool=pool)
         redis_server.ping()
     except Exception:
         redis_server = None
@@ -401,18 +1647,37 @@ def inititalize_redis():
         # if you end up here, redis instance is down.
         print '*** FATAL ERROR: Could not connect to the Redis Service'
         exit(1)
+    register_scripts()
+    start_invalidation_listener()
 
 
+# Connection counts of the shared pool, to size it against the worker count
+def redis_pool_stats():
+    pool = redis_server.connection_pool
+    created = len(pool._connections)
+    idle = len([connection for connection in pool.pool.queue if connection is not None])
+    return {
+        'max_connections': pool.max_connections,
+        'created_connections': created,
+        'in_use_connections': created - idle,
+        'idle_connections': idle,
+    }
+
 # Get the next ID
 def get_next_id():
     return redis_server.hget('nextId', 'nextId')
 
+# Connects this process to Redis and returns the app. WSGI servers call it
+# in every worker after forking, see wsgi.py
+def create_app():
+    inititalize_redis()
+    return app
 
 ######################################################################
 #   M A I N
 ######################################################################
 if __name__ == "__main__":
-    inititalize_redis()
+    create_app()
     # this line is used to empty database
     # redis_server.flushdb()
     # Get bindings from the environment
@@ -0,0 +1,123 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Redis round trips and commands of every route, recorded by the metrics
+# client at two database sizes. A route fails when it needs more round
+# trips than its budget, or more commands once the database is bigger.
+# run with:
+# python test_round_trips.py
+# nosetests test_round_trips.py
+
+import time
+import unittest
+import json
+import server
+from metrics import metrics
+
+SMALL_DATABASE = 20
+LARGE_DATABASE = 500
+
+# (route, method, url, body, most round trips) where {alpha}, {beta} and
+# {gamma} are the ids of the accounts the test creates and {recent} a time
+# after every other account was written. A pipeline is one round trip.
+# The writes that read the account first WATCH it, so they take three.
+ROUTES = [
+    ('index', 'GET', '/', None, 0),
+    ('diagnostics', 'GET', '/diagnostics', None, 0),
+    ('metrics', 'GET', '/metrics', None, 0),
+    ('get account', 'GET', '/accounts/{alpha}', None, 1),
+    ('list by name', 'GET', '/accounts?name=Alpha', None, 3),
+    ('list by type', 'GET', '/accounts?type=2', None, 3),
+    ('list by active', 'GET', '/accounts?active=true', None, 3),
+    ('list page', 'GET', '/accounts?limit=10', None, 3),
+    ('list ids', 'GET', '/accounts?ids={alpha},{beta}', None, 1),
+    ('query ids', 'POST', '/accounts/query', '{{"ids": [{alpha}, {beta}]}}', 1),
+    ('name prefix', 'GET', '/accounts?name_prefix=al&limit=10', None, 3),
+    ('balance range', 'GET', '/accounts?min_balance=50&max_balance=1000', None, 3),
+    ('top balances', 'GET', '/accounts?sort=balance&order=desc&limit=10', None, 3),
+    ('created window', 'GET', '/accounts?created_after={recent}', None, 3),
+    ('updated since', 'GET', '/accounts?updated_since={recent}', None, 3),
+    ('combined', 'GET', '/accounts?active=true&type=2&name=Alpha', None, 4),
+    ('stats', 'GET', '/accounts/stats', None, 1),
+    ('create', 'POST', '/accounts', '{{"name": "Delta", "balance": 10, "active": 1}}', 1),
+    ('bulk create', 'POST', '/accounts/bulk', '[{{"name": "Delta", "balance": 10, "active": 1}}]', 2),
+    ('update', 'PUT', '/accounts/{beta}', '{{"name": "Beta", "balance": 60, "active": 1, "accounttype": 2}}', 3),
+    ('deposit', 'POST', '/accounts/{alpha}/deposit', '{{"amount": 5}}', 1),
+    ('withdraw', 'POST', '/accounts/{alpha}/withdraw', '{{"amount": 5}}', 1),
+    ('transfer', 'POST', '/transfers', '{{"from": {alpha}, "to": {beta}, "amount": 1}}', 1),
+    ('deactivate', 'PUT', '/accounts/{beta}/deactivate', None, 3),
+    ('delete', 'DELETE', '/accounts/{gamma}', None, 3),
+]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRoundTrips(unittest.TestCase):
+
+    def setUp(self):
+        server.app.debug = True
+        self.app = server.app.test_client()
+        server.inititalize_redis()
+
+    def tearDown(self):
+        server.redis_server.flushdb()
+
+    # Fills the database with size inactive type 0 accounts worth less than
+    # $50, written before the accounts the routes read, which are returned
+    def seed(self, size):
+        server.redis_server.flushdb()
+        written = int(time.time()) - 3600
+        pipe = server.redis_server.pipeline(transaction=False)
+        for id in range(1, size + 1):
+            server.queue_account(pipe, {'id': str(id), 'name': 'Filler', 'balance': id, 'accounttype': '0',
+                                        'active': 'false', 'created_time': written,
+                                        'last_updated_time': written})
+        pipe.hset('nextId', 'nextId', size + 1)
+        pipe.execute()
+        ids = {'recent': written + 60}
+        for name, balance in (('Alpha', 100), ('Beta', 50), ('Gamma', 70)):
+            data = json.dumps({'name': name, 'balance': balance, 'active': 1, 'accounttype': 2})
+            resp = self.app.post('/accounts', data=data, content_type='application/json')
+            ids[name.lower()] = json.loads(resp.data)['id']
+        return ids
+
+    # What each route asked of Redis, as {route: (round trips, commands)}
+    def record(self, size):
+        ids = self.seed(size)
+        recorded = {}
+        for name, method, url, body, budget in ROUTES:
+            resp = self.app.open(url.format(**ids), method=method, data=body and body.format(**ids),
+                                 content_type='application/json')
+            self.assertTrue(resp.status_code < 400, '%s returned %d' % (name, resp.status_code))
+            commands = metrics.request_commands()
+            recorded[name] = (commands['round_trips'], commands['commands'])
+        return recorded
+
+    def test_round_trip_budgets(self):
+        small = self.record(SMALL_DATABASE)
+        large = self.record(LARGE_DATABASE)
+        failures = []
+        for name, method, url, body, budget in ROUTES:
+            if large[name][0] > budget:
+                failures.append('%s: %d round trips, the budget is %d' % (name, large[name][0], budget))
+            if large[name] != small[name]:
+                failures.append('%s: %s round trips and commands with %d accounts, %s with %d'
+                                % (name, small[name], SMALL_DATABASE, large[name], LARGE_DATABASE))
+        self.assertEqual(failures, [])
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -4,17 +4,29 @@
 # coverage report -m --include= server.py
 
 import datetime
+import glob
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import json
 import server
+from cache import LRUCache
+from metrics import Metrics, write_snapshot
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
+HTTP_403_ACCESS_FORBIDDEN = 403
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
+HTTP_500_INTERNAL_SERVER_ERROR = 500
 
 ######################################################################
 #  T E S T   C A S E S
@@ -56,6 +68,23 @@ class TestBankServer(unittest.TestCase):
         self.assertTrue(resp.status_code == HTTP_200_OK)
         self.assertTrue(new_json == data)
 
+    def test_create_account_concurrently_allocates_unique_ids(self):
+        ids = []
+        def create():
+            client = server.app.test_client()
+            data = json.dumps({'name': 'Zed', 'balance': 1, 'active': 1})
+            resp = client.post('/accounts', data=data, content_type='application/json')
+            ids.append(json.loads(resp.data)['id'])
+        threads = [threading.Thread(target=create) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(set(ids)) == 10)
+        members = server.redis_server.smembers(server.index_key('name', 'Zed'))
+        self.assertTrue(set(ids) <= members)
+        self.assertFalse(server.ID_PLACEHOLDER in members)
+
     def test_create_account_missing_active_attribute(self):
         new_account = {'name': 'john', 'balance': 100}
         data = json.dumps(new_account)
@@ -189,13 +218,158 @@ class TestBankServer(unittest.TestCase):
         self.assertTrue(new_json['error'] == 'Not a valid value for active parameter')
 
 
+    def test_create_account_reports_every_error(self):
+        new_account = {'name': 'john2', 'balance' : '1,000.123', 'active': 'no', 'accounttype': 5}
+        data = json.dumps(new_account)
+        resp = self.app.post('/accounts', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp_json = json.loads(resp.data)
+        self.assertTrue(resp_json['error'] == "Missing or invalid ['accounttype']")
+        self.assertTrue(resp_json['errors'][1:] == ['More than two digits after the decimal in balance parameter',
+                                                    'Not a valid value for active parameter',
+                                                    'Invalid name.'])
+
+    # Runs change once, between the read and the write of the next write_account.
+    # The original is restored after the test even when that write never comes.
+    def interleave(self, change):
+        remove_from_indexes = server.remove_from_indexes
+        self.addCleanup(setattr, server, 'remove_from_indexes', remove_from_indexes)
+        def interleaved(pipe, account):
+            server.remove_from_indexes = remove_from_indexes
+            change()
+            remove_from_indexes(pipe, account)
+        server.remove_from_indexes = interleaved
+        return remove_from_indexes
+
+    def test_concurrent_renames_keep_the_indexes(self):
+        rename = lambda name: json.dumps({'name': name, 'balance': 1, 'active': 1})
+        self.interleave(lambda: self.app.put('/accounts/' + self.idRef, data=rename('Inner'),
+                                             content_type='application/json'))
+        resp = self.app.put('/accounts/' + self.idRef, data=rename('Outer'), content_type='application/json')
+        self.assertTrue(json.loads(resp.data)['name'] == 'Outer')
+        self.assertTrue(server.redis_server.smembers(server.index_key('name', 'Inner')) == set())
+        self.assertTrue(self.idRef in server.redis_server.smembers(server.index_key('name', 'Outer')))
+        members = server.redis_server.zrangebylex(server.NAME_LEX_INDEX, '-', '+')
+        self.assertTrue([member for member in members if member.endswith(':' + self.idRef)] ==
+                        ['outer:' + self.idRef])
+
+    def test_writes_to_busy_accounts_give_up(self):
+        remove_from_indexes = server.remove_from_indexes
+        def always_changed(pipe, account):
+            server.redis_server.hincrby(self.idRef, server.FIELD_CODES['balance'], 0)
+            remove_from_indexes(pipe, account)
+        self.addCleanup(setattr, server, 'remove_from_indexes', remove_from_indexes)
+        self.addCleanup(setattr, server, 'WRITE_BACKOFF_SECONDS', server.WRITE_BACKOFF_SECONDS)
+        server.remove_from_indexes = always_changed
+        server.WRITE_BACKOFF_SECONDS = 0
+        data = json.dumps({'name': 'Busy', 'balance': 1, 'active': 1})
+        for resp in (self.app.put('/accounts/' + self.idRef, data=data, content_type='application/json'),
+                     self.app.put('/accounts/' + self.idRef + '/deactivate'),
+                     self.app.delete('/accounts/' + self.idRef)):
+            self.assertTrue(resp.status_code == HTTP_409_CONFLICT)
+        resp = self.app.get('/accounts/' + self.idRef)
+        self.assertTrue(json.loads(resp.data)['name'] == 'Gina')
+
+    def test_deposit_during_deactivate(self):
+        data = json.dumps({'name': 'Dora', 'balance': 100, 'active': 1})
+        id = json.loads(self.app.post('/accounts', data=data, content_type='application/json').data)['id']
+        self.interleave(lambda: self.app.post('/accounts/' + id + '/deposit', data=json.dumps({'amount': 50}),
+                                              content_type='application/json'))
+        resp = self.app.put('/accounts/' + id + '/deactivate')
+        self.assertTrue(json.loads(resp.data)['balance'] == '150.00')
+        self.assertTrue(json.loads(resp.data)['active'] == 'false')
+        resp = self.app.get('/accounts/' + id)
+        self.assertTrue(json.loads(resp.data)['balance'] == '150.00')
+
+    def test_stats_match_the_accounts_after_concurrent_writes(self):
+        server.rebuild_stats()
+        data = json.dumps({'name': 'Dora', 'balance': 100, 'active': 1})
+        id = json.loads(self.app.post('/accounts', data=data, content_type='application/json').data)['id']
+        deposit = lambda: self.app.post('/accounts/' + id + '/deposit', data=json.dumps({'amount': 50}),
+                                        content_type='application/json')
+        data = json.dumps({'name': 'Dora', 'balance': 20, 'active': 1, 'accounttype': 3})
+        for write in (lambda: self.app.put('/accounts/' + id, data=data, content_type='application/json'),
+                      lambda: self.app.put('/accounts/' + id + '/deactivate'),
+                      lambda: self.app.put('/accounts/' + id, data=data, content_type='application/json'),
+                      lambda: self.app.delete('/accounts/' + id)):
+            self.interleave(deposit)
+            write()
+            kept = self.app.get('/accounts/stats').data
+            server.rebuild_stats()
+            self.assertTrue(json.loads(kept) == json.loads(self.app.get('/accounts/stats').data))
+
+    def test_create_account_reports_non_ascii_values(self):
+        data = json.dumps({'name': 'Eve', 'balance': u'\xe9', 'active': u'\xe9'})
+        for resp in (self.app.post('/accounts', data=data, content_type='application/json'),
+                     self.app.put('/accounts/' + self.idRef, data=data, content_type='application/json')):
+            self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+            self.assertTrue(json.loads(resp.data)['errors'] == ['Not a valid number for balance parameter',
+                                                                'Not a valid value for active parameter'])
+        resp = self.app.post('/accounts/bulk', data='[%s]' % data, content_type='application/json')
+        self.assertTrue(json.loads(resp.data)['results'][0]['status'] == HTTP_400_BAD_REQUEST)
+        data = json.dumps({'amount': u'\xe9'})
+        resp = self.app.post('/accounts/' + self.idRef + '/deposit', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        data = json.dumps({'from': self.idRef, 'to': self.idRef, 'amount': u'\xe9'})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_create_account_with_non_object_payload(self):
+        resp = self.app.post('/accounts', data='["Gina"]', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.put('/accounts/' + self.idRef, data='["Gina"]', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
     def test_create_account_invalid_accounttype(self):
         new_account = {'name':'test','active': '1', 'balance': 100,'accounttype':5}
         data = json.dumps(new_account)
         resp = self.app.post('/accounts', data=data, content_type='application/json')
         # check the return message and return code
         self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
-
+        for accounttype in (True, 1.0, '1'):
+            new_account['accounttype'] = accounttype
+            data = json.dumps(new_account)
+            resp = self.app.post('/accounts', data=data, content_type='application/json')
+            self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+
+    def test_create_accounts_in_bulk(self):
+        new_accounts = [{'name': 'Bulk', 'balance': 10, 'active': 1},
+                        {'name': 'Bulk2', 'balance': 10, 'active': 1},
+                        {'name': 'Bulk', 'balance': '1,000', 'active': 'f', 'accounttype': 2}]
+        data = json.dumps(new_accounts)
+        resp = self.app.post('/accounts/bulk', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_201_CREATED)
+        new_json = json.loads(resp.data)
+        self.assertTrue(new_json['created'] == 2)
+        self.assertTrue(new_json['failed'] == 1)
+        self.assertTrue(new_json['results'][1]['error'] == 'Invalid name.')
+        created = new_json['results'][2]['account']
+        self.assertTrue(created['balance'] == '1000.00')
+        self.assertTrue(created['active'] == 'false')
+        self.assertTrue(created['accounttype'] == '2')
+
+        resp = self.app.get('/accounts/' + created['id'])
+        self.assertTrue(json.loads(resp.data) == created)
+        resp = self.app.get('/accounts?name=Bulk')
+        self.assertTrue(created in json.loads(resp.data))
+
+    def test_create_accounts_in_bulk_from_ndjson(self):
+        data = '{"name": "Ann", "balance": 5, "active": 1}\n\n{"name": "Ben", "balance": 6, "active": 0}\n'
+        resp = self.app.post('/accounts/bulk', data=data, content_type='application/x-ndjson')
+        self.assertTrue(resp.status_code == HTTP_201_CREATED)
+        results = json.loads(resp.data)['results']
+        self.assertTrue([result['account']['name'] for result in results] == ['Ann', 'Ben'])
+        self.assertTrue(int(results[1]['account']['id']) == int(results[0]['account']['id']) + 1)
+
+    def test_create_accounts_in_bulk_with_bad_body(self):
+        resp = self.app.post('/accounts/bulk', data='[]', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/accounts/bulk', data='{"name": "Ann"', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/accounts/bulk', data='[1, {"name": "Ann"}]', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        self.assertTrue(json.loads(resp.data)['failed'] == 2)
 
     def test_update_account(self):
         # Now the id of an user to update
@@ -490,6 +664,382 @@ class TestBankServer(unittest.TestCase):
         # Clean up
         self.app.delete('/accounts/'+id, data=data, content_type='application/json')
 
+    def test_deposit_and_withdraw(self):
+        self.app.put('/accounts/' + self.idRef, data=json.dumps({'name': 'Gina', 'balance': 1000, 'active': 1}), content_type='application/json')
+        resp = self.app.post('/accounts/' + self.idRef + '/deposit', data=json.dumps({'amount': '0.55'}), content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(json.loads(resp.data)['balance'] == '1000.55')
+        resp = self.app.post('/accounts/' + self.idRef + '/withdraw', data=json.dumps({'amount': 1000}), content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(json.loads(resp.data)['balance'] == '0.55')
+
+        resp = self.app.post('/accounts/' + self.idRef + '/withdraw', data=json.dumps({'amount': 1}), content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_409_CONFLICT)
+        resp = self.app.get('/accounts/' + self.idRef)
+        self.assertTrue(json.loads(resp.data)['balance'] == '0.55')
+
+    def test_deposit_errors(self):
+        data = json.dumps({'amount': 1})
+        # the account created in setUp is not active
+        resp = self.app.post('/accounts/' + self.idRef + '/deposit', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_403_ACCESS_FORBIDDEN)
+        resp = self.app.post('/accounts/nextId/deposit', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
+        resp = self.app.post('/accounts/' + server.get_next_id() + '/deposit', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
+        for amount in ('0', '-1', '1.001', 'ten'):
+            data = json.dumps({'amount': amount})
+            resp = self.app.post('/accounts/' + self.idRef + '/deposit', data=data, content_type='application/json')
+            self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/accounts/' + self.idRef + '/deposit', data='{"amount"', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_transfer(self):
+        accounts = []
+        for balance in (100, 50):
+            data = json.dumps({'name': 'Payer', 'balance': balance, 'active': 1})
+            resp = self.app.post('/accounts', data=data, content_type='application/json')
+            accounts.append(json.loads(resp.data)['id'])
+        data = json.dumps({'from': accounts[0], 'to': int(accounts[1]), 'amount': '99.99'})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        resp_json = json.loads(resp.data)
+        self.assertTrue(resp_json['from']['balance'] == '0.01')
+        self.assertTrue(resp_json['to']['balance'] == '149.99')
+
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_409_CONFLICT)
+        resp = self.app.get('/accounts/' + accounts[1])
+        self.assertTrue(json.loads(resp.data)['balance'] == '149.99')
+
+    def test_balance_limits(self):
+        data = json.dumps({'name': 'Rich', 'balance': '100000000000000000', 'active': 1})
+        resp = self.app.post('/accounts', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        # 15 digits of cents, which Lua would format as 1e+15
+        data = json.dumps({'name': 'Rich', 'balance': '10000000000000', 'active': 1})
+        id = json.loads(self.app.post('/accounts', data=data, content_type='application/json').data)['id']
+        data = json.dumps({'name': 'Poor', 'balance': 0, 'active': 1})
+        other = json.loads(self.app.post('/accounts', data=data, content_type='application/json').data)['id']
+        data = json.dumps({'from': id, 'to': other, 'amount': '10000000000000'})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(json.loads(resp.data)['to']['balance'] == '10000000000000.00')
+        data = json.dumps({'amount': '10000000000000'})
+        resp = self.app.post('/accounts/' + other + '/withdraw', data=data, content_type='application/json')
+        self.assertTrue(json.loads(resp.data)['balance'] == '0.00')
+        data = json.dumps({'amount': server.format_cents(server.MAX_CENTS)})
+        resp = self.app.post('/accounts/' + other + '/deposit', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        data = json.dumps({'amount': 1})
+        resp = self.app.post('/accounts/' + other + '/deposit', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_409_CONFLICT)
+        resp = self.app.get('/accounts?sort=balance&order=desc&limit=1')
+        self.assertTrue(json.loads(resp.data)[0]['id'] == other)
+        # the database is shared between tests, keep the top balances sane
+        self.app.delete('/accounts/' + other)
+        self.app.delete('/accounts/' + id)
+
+    def test_transfer_errors(self):
+        data = json.dumps({'name': 'Payer', 'balance': 100, 'active': 1})
+        resp = self.app.post('/accounts', data=data, content_type='application/json')
+        id = json.loads(resp.data)['id']
+        # the account created in setUp is not active
+        data = json.dumps({'from': id, 'to': self.idRef, 'amount': 1})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_403_ACCESS_FORBIDDEN)
+        resp = self.app.get('/accounts/' + id)
+        self.assertTrue(json.loads(resp.data)['balance'] == '100.00')
+
+        for to in ('nextId', u'\xe9'):
+            data = json.dumps({'from': id, 'to': to, 'amount': 1})
+            resp = self.app.post('/transfers', data=data, content_type='application/json')
+            self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
+        data = json.dumps({'from': id, 'amount': 1})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        data = json.dumps({'from': id, 'to': id, 'amount': 1})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        data = json.dumps({'from': id, 'to': self.idRef})
+        resp = self.app.post('/transfers', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_account_stats(self):
+        server.rebuild_stats()
+        before = json.loads(self.app.get('/accounts/stats').data)
+        data = json.dumps({'name': 'Sal Ami', 'balance': '20.25', 'active': 1, 'accounttype': 2})
+        resp = self.app.post('/accounts', data=data, content_type='application/json')
+        id = json.loads(resp.data)['id']
+        data = json.dumps({'amount': '5.25'})
+        self.app.post('/accounts/' + id + '/withdraw', data=data, content_type='application/json')
+        self.app.put('/accounts/' + self.idRef + '/deactivate')
+
+        resp = self.app.get('/accounts/stats')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        after = json.loads(resp.data)
+        self.assertTrue(after['count'] == before['count'] + 1)
+        self.assertTrue(after['active']['true'] == before['active']['true'] + 1)
+        self.assertTrue(after['active']['false'] == before['active']['false'])
+        self.assertTrue(after['accounttype']['2']['count'] == before['accounttype']['2']['count'] + 1)
+        self.assertTrue(float(after['accounttype']['2']['balance']) - float(before['accounttype']['2']['balance']) == 15)
+
+        self.app.delete('/accounts/' + id)
+        self.assertTrue(json.loads(self.app.get('/accounts/stats').data) == before)
+        server.rebuild_stats()
+        self.assertTrue(json.loads(self.app.get('/accounts/stats').data) == before)
+
+    def test_balance_range(self):
+        ids = []
+        for balance in ('123456.01', '123456.02', '123456.03'):
+            data = json.dumps({'name': 'Rich', 'balance': balance, 'active': 1})
+            resp = self.app.post('/accounts', data=data, content_type='application/json')
+            ids.append(json.loads(resp.data)['id'])
+        resp = self.app.get('/accounts?min_balance=123456.01&max_balance=123456.02')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue([account['id'] for account in json.loads(resp.data)] == ids[:2])
+
+        data = json.dumps({'amount': '1000000'})
+        self.app.post('/accounts/' + ids[0] + '/deposit', data=data, content_type='application/json')
+        resp = self.app.get('/accounts?sort=balance&order=desc&limit=2')
+        top = json.loads(resp.data)
+        self.assertTrue([account['id'] for account in top] == [ids[0], ids[2]])
+        self.assertTrue(top[0]['balance'] == '1123456.01')
+
+    def test_balance_range_bad_request(self):
+        for query in ('min_balance=abc', 'max_balance=-1', 'sort=name', 'sort=balance&order=up',
+                      'sort=balance&limit=0'):
+            resp = self.app.get('/accounts?' + query)
+            self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_time_windows(self):
+        now = int(time.time())
+        server.redis_server.hset(self.idRef, server.FIELD_CODES['created_time'], now - 86400)
+        server.rebuild_indexes()
+        resp = self.app.get('/accounts?created_before=%d' % (now - 3600))
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(self.idRef in [account['id'] for account in json.loads(resp.data)])
+
+        resp = self.app.get('/accounts?created_after=%d' % (now - 3600))
+        self.assertTrue(self.idRef not in [account['id'] for account in json.loads(resp.data)])
+
+        data = json.dumps({'name': 'Saver', 'balance': 1, 'active': 1})
+        resp = self.app.post('/accounts', data=data, content_type='application/json')
+        id = json.loads(resp.data)['id']
+        server.redis_server.hset(id, server.FIELD_CODES['last_updated_time'], now - 7200)
+        server.rebuild_indexes()
+        data = json.dumps({'amount': 1})
+        self.app.post('/accounts/' + id + '/deposit', data=data, content_type='application/json')
+        since = server.format_time(now - 60)
+        resp = self.app.get('/accounts?updated_since=' + since)
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(id in [account['id'] for account in json.loads(resp.data)])
+
+        server.redis_server.hset(id, server.FIELD_CODES['last_updated_time'], now - 7200)
+        server.rebuild_indexes()
+        self.app.put('/accounts/' + id + '/deactivate')
+        resp = self.app.get('/accounts?updated_since=' + since)
+        self.assertTrue(id in [account['id'] for account in json.loads(resp.data)])
+
+    def test_range_list_etags_change_on_deposit(self):
+        data = json.dumps({'name': 'Saver', 'balance': 1, 'active': 1})
+        id = json.loads(self.app.post('/accounts', data=data, content_type='application/json').data)['id']
+        for query in ('created_after=1', 'name_prefix=sa'):
+            resp = self.app.get('/accounts?' + query)
+            etag = resp.headers['ETag']
+            data = json.dumps({'amount': 1})
+            self.app.post('/accounts/' + id + '/deposit', data=data, content_type='application/json')
+            resp = self.app.get('/accounts?' + query, headers={'If-None-Match': etag})
+            self.assertTrue(resp.status_code == HTTP_200_OK)
+
+    def test_time_windows_bad_request(self):
+        for query in ('created_after=yesterday', 'updated_since=1&limit=x',
+                      u'created_after=\xb2'.encode('utf-8'), 'created_after=9999-12-31 23:00:00'):
+            resp = self.app.get('/accounts?' + query)
+            self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_name_prefix(self):
+        ids = []
+        for name in ('Zoltan', 'zoe Ball', 'ZOLA'):
+            data = json.dumps({'name': name, 'balance': 1, 'active': 1})
+            resp = self.app.post('/accounts', data=data, content_type='application/json')
+            ids.append(json.loads(resp.data)['id'])
+        resp = self.app.get('/accounts?name_prefix=zo')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        names = [account['name'] for account in json.loads(resp.data)]
+        self.assertTrue(names[:3] == ['zoe Ball', 'ZOLA', 'Zoltan'])
+        resp = self.app.get('/accounts?name_prefix=ZOL&limit=1')
+        self.assertTrue([account['name'] for account in json.loads(resp.data)] == ['ZOLA'])
+
+        data = json.dumps({'name': 'Mia', 'balance': 1, 'active': 1})
+        self.app.put('/accounts/' + ids[2], data=data, content_type='application/json')
+        self.app.delete('/accounts/' + ids[0])
+        resp = self.app.get('/accounts?name_prefix=zol')
+        self.assertTrue(json.loads(resp.data) == [])
+        resp = self.app.get('/accounts?name_prefix=zo&limit=0')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_combined_filters(self):
+        ids = []
+        for name, type, active, balance in (('Xi', 2, 1, 10), ('Xi', 2, 0, 20), ('Xi', 1, 1, 30),
+                                            ('Xia', 2, 1, 40), ('Xi', 2, 1, 50)):
+            data = json.dumps({'name': name, 'accounttype': type, 'active': active, 'balance': balance})
+            resp = self.app.post('/accounts', data=data, content_type='application/json')
+            ids.append(json.loads(resp.data)['id'])
+        resp = self.app.get('/accounts?name=Xi&type=2&active=true')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue([account['id'] for account in json.loads(resp.data)] == [ids[0], ids[4]])
+
+        resp = self.app.get('/accounts?name_prefix=xi&active=true&min_balance=20&sort=balance&order=desc')
+        self.assertTrue([account['id'] for account in json.loads(resp.data)] == [ids[4], ids[3], ids[2]])
+        resp = self.app.get('/accounts?name_prefix=xi&type=2&created_after=%d&limit=1' % (time.time() - 3600))
+        self.assertTrue([account['id'] for account in json.loads(resp.data)] == [ids[0]])
+        resp = self.app.get('/accounts?name=Xi&type=3')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(json.loads(resp.data) == [])
+        resp = self.app.get('/accounts?name=Xi&min_balance=x')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
+    def test_create_app(self):
+        app = server.create_app()
+        self.assertTrue(app is server.app)
+        self.assertTrue(server.redis_server.ping())
+
+    def test_metrics(self):
+        server.metrics.reset()
+        self.app.get('/accounts/' + self.idRef)
+        self.app.get('/accounts/' + self.idRef)
+        resp = self.app.get('/metrics')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        lines = resp.data.splitlines()
+        labels = '{route="/accounts/<id>",method="GET"'
+        self.assertTrue('http_requests_total%s,status="200"} 2' % labels in lines)
+        self.assertTrue('http_request_duration_seconds_count%s,status="200"} 2' % labels in lines)
+        self.assertTrue('redis_commands_total%s} 4' % labels in lines)
+        self.assertTrue('redis_commands_per_request_bucket%s,le="2"} 2' % labels in lines)
+        self.assertTrue(any(line.startswith('redis_pool_connections{state="max"}') for line in lines))
+
+    def test_metrics_of_all_workers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        workers = [Metrics(directory), Metrics(directory)]
+        for worker in workers:
+            worker.extra = lambda: {'account_cache_entries': ('gauge', 'Accounts in the cache.', {(): 3})}
+            worker.start_request()
+            worker.record_commands(2, 0.001)
+            worker.finish_request('/accounts/<id>', 'GET', 200)
+        workers[1].flush()
+        # a worker that exited, with no process left behind its pid
+        exited = workers[1].snapshot()
+        exited['requests'] = {('/accounts', 'GET', '200'): 5}
+        write_snapshot(os.path.join(directory, '999999999-exited.json'), exited)
+        lines = workers[0].render().splitlines()
+        self.assertTrue('http_requests_total{route="/accounts/<id>",method="GET",status="200"} 2' in lines)
+        self.assertTrue('http_requests_total{route="/accounts",method="GET",status="200"} 5' in lines)
+        self.assertTrue('redis_commands_total{route="/accounts/<id>",method="GET"} 6' in lines)
+        self.assertTrue('redis_commands_per_request_bucket{route="/accounts/<id>",method="GET",le="2"} 3' in lines)
+        self.assertTrue('account_cache_entries 6' in lines)
+
+    def test_metrics_count_server_errors(self):
+        server.metrics.reset()
+        server.app.debug = False
+        def fail(id):
+            raise RuntimeError('boom')
+        self.addCleanup(server.app.view_functions.__setitem__, 'get_account_by_id',
+                        server.app.view_functions['get_account_by_id'])
+        server.app.view_functions['get_account_by_id'] = fail
+        resp = self.app.get('/accounts/' + self.idRef)
+        self.assertTrue(resp.status_code == HTTP_500_INTERNAL_SERVER_ERROR)
+        lines = self.app.get('/metrics').data.splitlines()
+        self.assertTrue('http_requests_total{route="/accounts/<id>",method="GET",status="500"} 1' in lines)
+
+    def test_profile_slow_requests(self):
+        profiler = server.request_profiler
+        settings = (profiler.directory, profiler.sample_rate, profiler.slow_ms, profiler.max_files)
+        profiler.directory, profiler.sample_rate, profiler.slow_ms, profiler.max_files = \
+            tempfile.mkdtemp(), 1, 0, 2
+        try:
+            for _ in range(3):
+                self.app.get('/accounts?name=Gina&type=0')
+            profiles = sorted(glob.glob(os.path.join(profiler.directory, '*.prof')))
+            self.assertTrue(len(profiles) == 2)
+            self.assertTrue(pstats.Stats(profiles[0]).total_calls > 0)
+            with open(profiles[0][:-len('.prof')] + '.json') as details:
+                details = json.load(details)
+            self.assertTrue(details['route'] == '/accounts')
+            self.assertTrue(details['args'] == {'name': ['Gina'], 'type': ['0']})
+            self.assertTrue(details['redis']['commands'] == sum(details['redis']['breakdown'].values()))
+            self.assertTrue(details['redis']['breakdown'].get('HGETALL') >= 1)
+        finally:
+            shutil.rmtree(profiler.directory)
+            profiler.directory, profiler.sample_rate, profiler.slow_ms, profiler.max_files = settings
+
+    def test_store_account_json(self):
+        data = json.dumps({'name': 'Jay Son', 'balance': 10, 'active': 1})
+        resp = self.app.post('/accounts', data=data, content_type='application/json')
+        id = json.loads(resp.data)['id']
+        expected = [json.loads(self.app.get(url).data) for url in ('/accounts/' + id, '/accounts?name=Jay Son')]
+        mode = server.STORE_ACCOUNT_JSON
+        server.STORE_ACCOUNT_JSON = True
+        try:
+            # written before the mode was on, so the copy is built by the first read
+            for url, body in zip(('/accounts/' + id, '/accounts?name=Jay Son'), expected):
+                self.assertTrue(json.loads(self.app.get(url).data) == body)
+            self.assertTrue(json.loads(server.redis_server.get(server.json_key(id))) == expected[0])
+
+            data = json.dumps({'amount': '0.50'})
+            self.app.post('/accounts/' + id + '/deposit', data=data, content_type='application/json')
+            self.assertTrue(server.redis_server.get(server.json_key(id)) is None)
+            resp = self.app.get('/accounts?limit=1000')
+            account = [account for account in json.loads(resp.data)['accounts'] if account['id'] == id][0]
+            self.assertTrue(account['balance'] == '10.50')
+
+            data = json.dumps({'name': 'Jay Son', 'balance': 20, 'active': 1})
+            self.app.put('/accounts/' + id, data=data, content_type='application/json')
+            self.assertTrue(json.loads(server.redis_server.get(server.json_key(id)))['balance'] == '20.00')
+            self.app.delete('/accounts/' + id)
+            self.assertTrue(server.redis_server.get(server.json_key(id)) is None)
+        finally:
+            server.STORE_ACCOUNT_JSON = mode
+
+    def test_migrate_legacy_balance(self):
+        # as written by an older version
+        server.redis_server.delete(self.idRef, server.json_key(self.idRef))
+        server.redis_server.hmset(self.idRef, {'id': self.idRef, 'name': 'Legacy', 'balance': '1000.50',
+                                               'accounttype': '0', 'active': 'true',
+                                               'created_time': '2016-12-01 10:00:00',
+                                               'last_updated_time': '2016-12-01 10:00:00'})
+        resp = self.app.get('/accounts/' + self.idRef)
+        self.assertTrue(json.loads(resp.data)['balance'] == '1000.50')
+        resp = self.app.post('/accounts/' + self.idRef + '/deposit', data=json.dumps({'amount': 1}),
+                             content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_409_CONFLICT)
+        resp = self.app.put('/accounts/' + self.idRef + '/deactivate')
+        self.assertTrue(json.loads(resp.data)['active'] == 'false')
+        self.assertTrue(server.redis_server.hget(self.idRef, 'active') == 'false')
+        server.redis_server.hset(self.idRef, 'active', 'true')
+        self.assertTrue(server.migrate_accounts() >= 1)
+        stored = server.redis_server.hgetall(self.idRef)
+        self.assertTrue(sorted(stored) == sorted(server.FIELD_CODES.values()))
+        self.assertTrue(stored[server.FIELD_CODES['balance']] == '100050')
+        self.assertTrue(stored[server.FIELD_CODES['created_time']].isdigit())
+        self.assertTrue(server.migrate_accounts() == 0)
+        resp = self.app.get('/accounts/' + self.idRef)
+        self.assertTrue(json.loads(resp.data)['balance'] == '1000.50')
+        self.assertTrue(json.loads(resp.data)['created_time'] == '2016-12-01 10:00:00')
+        resp = self.app.post('/accounts/' + self.idRef + '/deposit', data=json.dumps({'amount': 1}),
+                             content_type='application/json')
+        self.assertTrue(json.loads(resp.data)['balance'] == '1001.50')
+
+    def test_compact_account_hash(self):
+        stored = server.redis_server.hgetall(self.idRef)
+        self.assertTrue(sorted(stored) == sorted(server.FIELD_CODES.values()))
+        self.assertTrue(server.account_from_hash(self.idRef, stored) ==
+                        server.account_from_hash(self.idRef, server.account_to_hash(server.read_account(self.idRef))))
+        report = server.memory_report()
+        self.assertTrue(report['sampled'] >= 1)
+        self.assertTrue(report['compact'] < report['long_field_names'])
+
     def test_get_an_account_by_id(self):
         #first need to create an account to get
         new_account = {'name': 'Hugh Jass', 'balance': 1000, 'active': 'false'}
@@ -505,6 +1055,87 @@ class TestBankServer(unittest.TestCase):
         self.assertEquals(account_response_json['balance'], '1000.00')
         self.assertEquals(account_response_json['active'], 'false')
 
+    def test_get_an_account_by_id_from_cache(self):
+        cache = server.account_cache
+        server.account_cache = LRUCache(10, 60)
+        try:
+            self.app.get('/accounts/' + self.idRef)
+            resp = self.app.get('/accounts/' + self.idRef)
+            self.assertTrue(json.loads(resp.data)['name'] == 'Gina')
+            stats = json.loads(self.app.get('/diagnostics').data)['account_cache']
+            self.assertTrue(stats['hits'] == 1 and stats['misses'] == 1)
+
+            update_account = {'name': 'Gwen', 'balance': 1000, 'active': 0}
+            data = json.dumps(update_account)
+            self.app.put('/accounts/' + self.idRef, data=data, content_type='application/json')
+            resp = self.app.get('/accounts/' + self.idRef)
+            self.assertTrue(json.loads(resp.data)['name'] == 'Gwen')
+        finally:
+            server.account_cache = cache
+
+    def test_account_writes_publish_invalidations(self):
+        pubsub = server.redis_server.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(server.ACCOUNT_INVALIDATION_CHANNEL)
+        self.app.put('/accounts/' + self.idRef + '/deactivate')
+        self.app.delete('/accounts/' + self.idRef)
+        messages = []
+        for i in range(100):
+            message = pubsub.get_message()
+            if message:
+                messages.append(message['data'])
+            if len(messages) == 2:
+                break
+            time.sleep(0.01)
+        self.assertTrue(messages == [self.idRef, self.idRef])
+        pubsub.close()
+
+    def test_lru_cache_bounds(self):
+        cache = LRUCache(2, 60)
+        cache.set('1', 'a')
+        cache.set('2', 'b')
+        cache.get('1')
+        cache.set('3', 'c')
+        self.assertTrue(cache.get('2') is None)
+        self.assertTrue(cache.get('1') == 'a')
+        token = cache.reserve('4')
+        cache.evict('4')
+        cache.set('4', 'stale', token)
+        self.assertTrue(cache.get('4') is None)
+        cache.set('4', 'd', cache.reserve('4'))
+        self.assertTrue(cache.get('4') == 'd')
+        cache = LRUCache(2, -1)
+        cache.set('1', 'a')
+        self.assertTrue(cache.get('1') is None)
+        cache = LRUCache(0, 60)
+        cache.set('1', 'a')
+        self.assertTrue(cache.get('1') is None)
+
+    def test_get_an_account_by_id_not_modified(self):
+        resp = self.app.get('/accounts/' + self.idRef)
+        etag = resp.headers['ETag']
+        resp = self.app.get('/accounts/' + self.idRef, headers={'If-None-Match': etag})
+        self.assertTrue(resp.status_code == HTTP_304_NOT_MODIFIED)
+        self.assertTrue(resp.data == '')
+
+        self.app.put('/accounts/' + self.idRef + '/deactivate')
+        resp = self.app.get('/accounts/' + self.idRef, headers={'If-None-Match': etag})
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(resp.headers['ETag'] != etag)
+
+    def test_get_account_list_not_modified(self):
+        resp = self.app.get('/accounts?name=Gina')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/accounts?name=Gina', headers={'If-None-Match': etag})
+        self.assertTrue(resp.status_code == HTTP_304_NOT_MODIFIED)
+        resp = self.app.get('/accounts?type=0', headers={'If-None-Match': etag})
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+
+        update_account = {'name': 'Gina', 'balance': 5, 'active': 1}
+        data = json.dumps(update_account)
+        self.app.put('/accounts/' + self.idRef, data=data, content_type='application/json')
+        resp = self.app.get('/accounts?name=Gina', headers={'If-None-Match': etag})
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+
     def test_get_an_account_by_id_returns_404_for_invalid_id(self):
         account_response = self.app.get('/accounts/nextId')
 
@@ -524,6 +1155,83 @@ class TestBankServer(unittest.TestCase):
         self.assertTrue( len(data) ==  self.get_account_count())
         self.assertFalse( 'nextId' in resp.data)
 
+    def test_get_account_list_by_page(self):
+        resp = self.app.get('/accounts')
+        all_ids = [account['id'] for account in json.loads(resp.data)]
+        page_ids = []
+        cursor = ''
+        while True:
+            resp = self.app.get('/accounts?limit=2&cursor=' + cursor)
+            self.assertTrue(resp.status_code == HTTP_200_OK)
+            page = json.loads(resp.data)
+            self.assertTrue(len(page['accounts']) <= 2)
+            page_ids += [account['id'] for account in page['accounts']]
+            if not page['next_cursor']:
+                break
+            cursor = page['next_cursor']
+        self.assertTrue(page_ids == all_ids)
+
+    def test_get_account_list_as_stream(self):
+        resp = self.app.get('/accounts?stream=1')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(resp.headers['Content-Type'] == 'application/x-ndjson')
+        accounts = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertTrue(len(accounts) == self.get_account_count())
+        small_batches = server.iter_accounts(server.iter_all_ids(batch_size=2), batch_size=3)
+        self.assertTrue([json.loads(server.dumps(account)) for account in small_batches] == accounts)
+
+        resp = self.app.get('/accounts?name=Gina', headers={'Accept': 'application/x-ndjson'})
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        for line in resp.data.splitlines():
+            self.assertTrue(json.loads(line)['name'] == 'Gina')
+
+        # as SSCAN may while the set is rehashed
+        server.redis_server.sscan_iter = lambda key, count: iter([self.idRef, self.idRef])
+        try:
+            resp = self.app.get('/accounts?name=Gina&stream=1')
+        finally:
+            del server.redis_server.sscan_iter
+        self.assertTrue(len(resp.data.splitlines()) == 1)
+
+        resp = self.app.get('/accounts?name=Xiao&stream=1')
+        self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
+
+    def test_get_account_list_with_invalid_limit(self):
+        resp = self.app.get('/accounts?limit=0')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/accounts?limit=10&cursor=nextId')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        for query in (u'limit=10&cursor=\u0661', u'limit=\u0661'):
+            resp = self.app.get(u'/accounts?' + query)
+            self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.get(u'/accounts/\u0661')
+        self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
+
+    def test_get_accounts_by_ids(self):
+        resp = self.app.get('/accounts?ids=%s,nextId,%s' % (self.idRef, server.get_next_id()))
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertTrue([account['id'] for account in data['found']] == [self.idRef])
+        self.assertTrue(data['missing'] == ['nextId', server.get_next_id()])
+
+    def test_query_accounts_by_ids(self):
+        data = json.dumps({'ids': [int(self.idRef), 'x', u'\xe9']})
+        resp = self.app.post('/accounts/query', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertTrue(data['found'][0]['name'] == 'Gina')
+        self.assertTrue(data['missing'] == ['x', u'\xe9'])
+
+        resp = self.app.post('/accounts/query', data='{"ids": 1}', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/accounts/query', data='{"ids": [1, {}]}', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/accounts/query', data='{"ids": [1', content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+        data = json.dumps({'ids': range(server.MAX_PAGE_SIZE + 1)})
+        resp = self.app.post('/accounts/query', data=data, content_type='application/json')
+        self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
+
     def test_get_account_list_with_existing_name(self):
         resp = self.app.get('/accounts?name=Gina')
         #print 'resp_data: ' + resp.data
@@ -572,6 +1280,35 @@ class TestBankServer(unittest.TestCase):
         resp = self.app.get('/accounts?active=junk')
         self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
 
+    def test_get_account_list_follows_updated_name(self):
+        update_account = {'name': 'Gwen', 'balance': 1000, 'active': 1}
+        data = json.dumps(update_account)
+        self.app.put('/accounts/' + self.idRef, data=data, content_type='application/json')
+
+        resp = self.app.get('/accounts?name=Gwen')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(self.idRef in [account['id'] for account in json.loads(resp.data)])
+        resp = self.app.get('/accounts?name=Gina')
+        if resp.status_code == HTTP_200_OK:
+            self.assertFalse(self.idRef in [account['id'] for account in json.loads(resp.data)])
+        resp = self.app.get('/accounts?active=true')
+        self.assertTrue(self.idRef in [account['id'] for account in json.loads(resp.data)])
+
+    def test_get_account_list_after_delete(self):
+        self.app.delete('/accounts/' + self.idRef)
+        resp = self.app.get('/accounts?type=0')
+        if resp.status_code == HTTP_200_OK:
+            self.assertFalse(self.idRef in [account['id'] for account in json.loads(resp.data)])
+
+    def test_rebuild_indexes(self):
+        server.redis_server.delete(server.index_key('name', 'Gina'))
+        resp = self.app.get('/accounts?name=Gina')
+        self.assertTrue(resp.status_code == HTTP_404_NOT_FOUND)
+        self.assertTrue(server.rebuild_indexes() == self.get_account_count())
+        resp = self.app.get('/accounts?name=Gina')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        self.assertTrue(self.idRef in [account['id'] for account in json.loads(resp.data)])
+
     def test_deactivate_a_non_exist_account(self):
         account_response = self.app.put('/accounts/nextId/deactivate')
         print account_response.status_code
@@ -631,6 +1368,14 @@ class TestBankServer(unittest.TestCase):
         resp_json = json.loads(resp.data)
         self.assertTrue(resp.status_code == HTTP_400_BAD_REQUEST)
 
+    def test_diagnostics(self):
+        resp = self.app.get('/diagnostics')
+        self.assertTrue(resp.status_code == HTTP_200_OK)
+        pool = json.loads(resp.data)['redis_pool']
+        self.assertTrue(pool['max_connections'] == server.redis_pool_settings()['max_connections'])
+        self.assertTrue(pool['created_connections'] == pool['in_use_connections'] + pool['idle_connections'])
+        self.assertTrue(pool['idle_connections'] >= 1)
+
     def test_connect_to_redis_exception(self):
         self.assertTrue(server.connect_to_redis("","","") == None)
 
@@ -0,0 +1,23 @@
+# Copyright 2016 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Production entry point, run with:
+# gunicorn -c gunicorn_config.py wsgi:app
+#
+# Every gunicorn worker imports this module after it has been forked, so each
+# one opens its own Redis connection pool and cache invalidation listener.
+
+from server import create_app
+
+app = create_app()